@@ -0,0 +1,216 @@
+import asyncio
+import math
+import os
+import re
+import time
+from collections import deque
+
+from fastapi.responses import JSONResponse
+
+
+def _env_int(name, default):
+    return int(os.getenv(name, str(default)))
+
+
+def _env_float(name, default):
+    return float(os.getenv(name, str(default)))
+
+
+class RouteClass:
+    """Admission settings for one class of routes; lower priority values are admitted first"""
+
+    def __init__(self, name, priority, max_concurrency, max_queue, queue_timeout):
+        self.name = name
+        self.priority = priority
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiters = deque()
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self.avg_service_ms = None
+
+    @classmethod
+    def from_env(cls, name, priority, max_concurrency, max_queue, queue_timeout):
+        prefix = f"ADMISSION_{name.upper()}"
+        return cls(
+            name,
+            priority,
+            _env_int(f"{prefix}_CONCURRENCY", max_concurrency),
+            _env_int(f"{prefix}_QUEUE", max_queue),
+            _env_float(f"{prefix}_QUEUE_TIMEOUT", queue_timeout)
+        )
+
+    def record_service_time(self, elapsed_ms):
+        # Exponentially weighted, used to estimate Retry-After
+        if self.avg_service_ms is None:
+            self.avg_service_ms = elapsed_ms
+        else:
+            self.avg_service_ms = 0.8 * self.avg_service_ms + 0.2 * elapsed_ms
+
+    def retry_after_seconds(self):
+        service_seconds = (self.avg_service_ms or 1000.0) / 1000.0
+        backlog = len(self.waiters) + self.active
+        return max(1, math.ceil(backlog * service_seconds / max(1, self.max_concurrency)))
+
+    def snapshot(self):
+        return {
+            "priority": self.priority,
+            "active": self.active,
+            "queued": len(self.waiters),
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "queue_timeout_seconds": self.queue_timeout,
+            "admitted": self.admitted,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_timeout": self.rejected_timeout,
+            "avg_service_ms": round(self.avg_service_ms, 1) if self.avg_service_ms is not None else None
+        }
+
+
+class AdmissionController:
+    """Per-class concurrency limits and bounded wait queues under a shared overall limit.
+
+    Runs entirely on the event loop. When a slot frees up, queued requests of the
+    highest-priority class are admitted first, so verification flows never wait
+    behind a backlog of dashboard reads.
+    """
+
+    def __init__(self, classes, classify, total_concurrency, exempt_paths=()):
+        for route_class in classes:
+            # A class can never run more than the shared limit allows
+            route_class.max_concurrency = min(route_class.max_concurrency, total_concurrency)
+        self.classes = {route_class.name: route_class for route_class in classes}
+        self._by_priority = sorted(classes, key=lambda route_class: route_class.priority)
+        self.classify = classify
+        self.total_concurrency = total_concurrency
+        self.total_active = 0
+        self.exempt_paths = set(exempt_paths)
+
+    def _can_run(self, route_class):
+        return route_class.active < route_class.max_concurrency and self.total_active < self.total_concurrency
+
+    def _higher_priority_waiting(self, route_class):
+        # Waiters held back only by their own class limit don't block other classes
+        return any(
+            other.waiters and other.active < other.max_concurrency
+            for other in self._by_priority
+            if other.priority <= route_class.priority
+        )
+
+    def _grant(self, route_class):
+        route_class.active += 1
+        route_class.admitted += 1
+        self.total_active += 1
+
+    def release(self, route_class):
+        route_class.active -= 1
+        self.total_active -= 1
+        self._wake()
+
+    def _wake(self):
+        for route_class in self._by_priority:
+            while route_class.waiters and self._can_run(route_class):
+                waiter = route_class.waiters.popleft()
+                if waiter.done():
+                    continue
+                self._grant(route_class)
+                waiter.set_result(True)
+
+    async def admit(self, route_class):
+        """Wait for a slot in route_class; returns a rejection response, or None once admitted"""
+        if self._can_run(route_class) and not self._higher_priority_waiting(route_class):
+            self._grant(route_class)
+            return None
+
+        if len(route_class.waiters) >= route_class.max_queue:
+            route_class.rejected_queue_full += 1
+            return self._reject(429, route_class, "queue is full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        route_class.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=route_class.queue_timeout)
+        except asyncio.TimeoutError:
+            if waiter.done():
+                # Admitted just as the timeout fired; keep the slot
+                return None
+            waiter.cancel()
+            route_class.waiters.remove(waiter)
+            route_class.rejected_timeout += 1
+            return self._reject(503, route_class, f"no capacity within {route_class.queue_timeout}s")
+        except asyncio.CancelledError:
+            # Client went away while queued; hand any slot we were just given back
+            if waiter.done() and not waiter.cancelled():
+                self.release(route_class)
+            else:
+                waiter.cancel()
+                if waiter in route_class.waiters:
+                    route_class.waiters.remove(waiter)
+            raise
+        return None
+
+    @staticmethod
+    def _reject(status_code, route_class, reason):
+        return JSONResponse(
+            status_code=status_code,
+            content={"error": f"Server busy: {route_class.name} {reason}", "route_class": route_class.name},
+            headers={
+                "Retry-After": str(route_class.retry_after_seconds()),
+                # Rejections skip the CORS middleware, so browsers still need to be able to read them
+                "Access-Control-Allow-Origin": "*"
+            }
+        )
+
+    def snapshot(self):
+        return {
+            "total_active": self.total_active,
+            "total_concurrency": self.total_concurrency,
+            "classes": {route_class.name: route_class.snapshot() for route_class in self._by_priority}
+        }
+
+
+class AdmissionMiddleware:
+    """ASGI middleware that holds a request's admission slot until its whole response body is sent.
+
+    A plain ASGI middleware rather than @app.middleware("http"): behind BaseHTTPMiddleware,
+    call_next returns once headers are ready, which would free the slot while /export or a
+    passthrough body is still streaming from a pooled connection or a portfolio budget slot.
+    """
+
+    def __init__(self, app, controller):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        controller = self.controller
+        if scope["type"] != "http" or scope["method"] == "OPTIONS" or scope["path"] in controller.exempt_paths:
+            await self.app(scope, receive, send)
+            return
+
+        route_class = controller.classes[controller.classify(scope["method"], scope["path"])]
+        rejection = await controller.admit(route_class)
+        if rejection is not None:
+            await rejection(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            route_class.record_service_time((time.perf_counter() - started) * 1000)
+            controller.release(route_class)
+
+
+VERIFICATION_PATH = re.compile(r"^/(verify-code|register-phone-number|request-verification-code)/[^/]+$")
+
+
+def classify_route(method, path):
+    """verification for time-sensitive code/registration flows, mutations for other writes, reads otherwise"""
+    if VERIFICATION_PATH.match(path):
+        return "verification"
+    if method in ("GET", "HEAD"):
+        return "reads"
+    return "mutations"
@@ -1,13 +1,35 @@
 
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Request, Header
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-import requests
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+from typing import List, Optional
+import asyncio
+import csv
+from contextlib import ExitStack
+import io
+import json
 import os
+import time
 from dotenv import load_dotenv
+from sqlalchemy import select, and_, or_
 from sqlalchemy.orm import Session
-from database import get_db, create_tables, WabaData, WabaPhoneNumber
-from datetime import datetime
+from database import (
+    get_db, create_tables, engine, SessionLocal, normalize_phone_number, phone_number_digits, DB_POOL_CAPACITY,
+    WabaData, WabaPhoneNumber, BusinessPortfolio, PreverifiedPhoneNumber
+)
+import graph_client
+import tracing
+from idempotency import IdempotencyStore
+from portfolios import resolve_portfolio, all_portfolios, budget_for
+from admission import AdmissionController, AdmissionMiddleware, RouteClass, classify_route
+from token_health import resolve_waba_token, check_stored_tokens, run_token_health_loop, token_problem
+from events import (
+    phone_number_events, format_sse,
+    PHONE_NUMBER_ADDED, PHONE_NUMBER_CODE_REQUESTED, PHONE_NUMBER_VERIFIED,
+    PHONE_NUMBER_REGISTERED, PHONE_NUMBER_DEREGISTERED, PHONE_NUMBER_DELETED
+)
+from datetime import datetime, timedelta
 
 # Load environment variables from .env file
 load_dotenv()
@@ -16,14 +38,55 @@ ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
 business_portfolio_id = os.getenv("BUSINESS_PORTFOLIO_ID")
 FACEBOOK_APP_ID = os.getenv("FACEBOOK_APP_ID")
 FACEBOOK_APP_SECRET = os.getenv("FACEBOOK_APP_SECRET")
+# Seconds between keep-alive comments on idle event streams
+SSE_HEARTBEAT_SECONDS = float(os.getenv("SSE_HEARTBEAT_SECONDS", "15"))
+# Fan-out limits for /fleet-overview
+FLEET_MAX_CONCURRENCY = int(os.getenv("FLEET_MAX_CONCURRENCY", "5"))
+FLEET_DEADLINE_SECONDS = float(os.getenv("FLEET_DEADLINE_SECONDS", "20"))
+# Limits for the bulk delete/deregister endpoints
+BULK_MAX_CONCURRENCY = int(os.getenv("BULK_MAX_CONCURRENCY", "5"))
+BULK_MAX_IDS = int(os.getenv("BULK_MAX_IDS", "200"))
+# Rows fetched per server-side cursor batch by /export
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+# Upper bound on time spent in Graph calls for one inbound request; clients may ask for less via X-Request-Timeout
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "30"))
+# How long results of requests sent with an Idempotency-Key are kept for replay
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+# Overall cap on requests being served at once; per-class limits come from ADMISSION_<CLASS>_* variables.
+# Admitted handlers each hold a database session, so this never exceeds the connection pool
+ADMISSION_TOTAL_CONCURRENCY = min(DB_POOL_CAPACITY, int(os.getenv("ADMISSION_TOTAL_CONCURRENCY", str(DB_POOL_CAPACITY))))
+# Default for the ?passthrough= flag on pure proxy endpoints
+GRAPH_PASSTHROUGH = os.getenv("GRAPH_PASSTHROUGH", "false").lower() in ("1", "true", "yes")
+# Upstream headers forwarded in passthrough mode; everything else (cookies, x-fb-debug, usage headers) is dropped
+PASSTHROUGH_HEADERS = {"content-type", "content-encoding", "content-length", "etag", "last-modified", "cache-control"}
 
-app = FastAPI()
+app = FastAPI(default_response_class=tracing.TracedJSONResponse)
+tracing.instrument_engine(engine)
 
 # Initialize database tables on startup
 @app.on_event("startup")
 async def startup_event():
     create_tables()
     print("Database tables created successfully")
+    # Handlers run in the threadpool; events they publish are handed to SSE queues on this loop
+    phone_number_events.bind_loop(asyncio.get_running_loop())
+    # Keep a reference so the background task isn't garbage collected
+    app.state.token_health_task = asyncio.create_task(run_token_health_loop(FACEBOOK_APP_ID, FACEBOOK_APP_SECRET))
+
+# Replay retried mutations that carry an Idempotency-Key instead of calling Graph again
+idempotency_store = IdempotencyStore(
+    routes=[
+        ("POST", r"/add-phone-number"),
+        ("POST", r"/register-phone-number/[^/]+"),
+        ("POST", r"/request-verification-code/[^/]+"),
+        ("POST", r"/subscribe-webhooks/[^/]+"),
+    ],
+    ttl_seconds=IDEMPOTENCY_TTL_SECONDS
+)
+
+@app.middleware("http")
+async def idempotency_middleware(request: Request, call_next):
+    return await idempotency_store.handle(request, call_next)
 
 # CORS settings: allow all origins
 app.add_middleware(
@@ -34,6 +97,64 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
+# Propagate a per-request deadline to every Graph call made while handling the request
+@app.middleware("http")
+async def request_deadline_middleware(request: Request, call_next):
+    budget = REQUEST_DEADLINE_SECONDS
+    requested = request.headers.get("x-request-timeout")
+    if requested:
+        try:
+            budget = min(budget, max(0.0, float(requested)))
+        except ValueError:
+            pass
+    token = graph_client.request_deadline.set(time.monotonic() + budget)
+    try:
+        return await call_next(request)
+    finally:
+        graph_client.request_deadline.reset(token)
+
+# Admission control: bounded concurrency and queues per route class, verification flows first
+admission_controller = AdmissionController(
+    classes=[
+        RouteClass.from_env("verification", priority=0, max_concurrency=6, max_queue=64, queue_timeout=10),
+        RouteClass.from_env("mutations", priority=1, max_concurrency=6, max_queue=32, queue_timeout=5),
+        RouteClass.from_env("reads", priority=2, max_concurrency=10, max_queue=64, queue_timeout=2),
+    ],
+    classify=classify_route,
+    total_concurrency=ADMISSION_TOTAL_CONCURRENCY,
+    exempt_paths=["/", "/admission-stats", "/graph-health", "/phone-number-events"]
+)
+
+# Added like the decorated middlewares, so it still sits between deadline propagation and tracing
+app.add_middleware(AdmissionMiddleware, controller=admission_controller)
+
+# Trace each request (route, Graph calls, DB queries, serialization) and report the breakdown in Server-Timing
+@app.middleware("http")
+async def tracing_middleware(request: Request, call_next):
+    request_span = tracing.start_request_span(
+        f"{request.method} {request.url.path}",
+        traceparent=request.headers.get("traceparent"),
+        attributes={"http.request.method": request.method, "url.path": request.url.path}
+    )
+    token = tracing.current_span.set(request_span)
+    try:
+        response = await call_next(request)
+        request_span.attributes["http.response.status_code"] = response.status_code
+    except Exception as e:
+        request_span.error = str(e)
+        raise
+    finally:
+        tracing.current_span.reset(token)
+        route = request.scope.get("route")
+        if route is not None:
+            # Name by route template so spans group as /waba-phone-numbers/{waba_id}
+            request_span.name = f"{request.method} {route.path}"
+            request_span.attributes["http.route"] = route.path
+        request_span.end()
+    
+    response.headers["Server-Timing"] = request_span.server_timing()
+    return response
+
 # Pydantic model for request body
 class PhoneNumberRequest(BaseModel):
     phone_number: str
@@ -42,6 +163,17 @@ class WabaRequest(BaseModel):
     code: str
     waba_id: str
 
+class BulkPhoneNumbersRequest(BaseModel):
+    number_ids: List[str]
+
+class PortfolioRequest(BaseModel):
+    portfolio_id: str
+    access_token: str
+    name: Optional[str] = None
+    # Budget overrides; omit to use the PORTFOLIO_* defaults
+    max_concurrency: Optional[int] = Field(None, gt=0)
+    requests_per_minute: Optional[int] = Field(None, gt=0)
+
 class RegisterPhoneRequest(BaseModel):
     pin: str
     
@@ -56,62 +188,192 @@ class RegisterPhoneRequest(BaseModel):
 async def root():
     return {"message": "Hello World"}
 
-@app.get("/phone-numbers")
-async def get_phone_numbers():
+def passthrough_request_headers(request: Request):
+    # Ask Graph for an encoding the client can decode, so the body can be forwarded without re-encoding
+    return {"Accept-Encoding": request.headers.get("accept-encoding", "identity")}
+
+def passthrough_response(upstream, on_close=None):
+    """Stream a Graph response to the client byte for byte, without decoding it"""
+    headers = {name: value for name, value in upstream.headers.items() if name.lower() in PASSTHROUGH_HEADERS}
+    
+    def body():
+        try:
+            yield from upstream.raw.stream(64 * 1024, decode_content=False)
+        finally:
+            upstream.close()
+            if on_close:
+                on_close()
+    
+    return StreamingResponse(body(), status_code=upstream.status_code, headers=headers)
 
+@app.get("/admission-stats")
+async def get_admission_stats():
+    """Active requests and queue depth per route class"""
+    return admission_controller.snapshot()
+
+@app.get("/graph-health")
+async def get_graph_health():
+    """Circuit breaker state per Graph path family"""
+    return {"circuits": graph_client.breaker_states()}
+
+def store_preverified_numbers(db: Session, portfolio_id: str, numbers: list):
+    """Replace a portfolio's stored preverified numbers with the full list from Graph, so they can be searched locally"""
     try:
-        # Use business portfolio ID from environment variables
-        if not business_portfolio_id:
-            return {"error": "BUSINESS_PORTFOLIO_ID not found in environment variables"}
-            
-        # Facebook Graph API endpoint - use preverified_numbers endpoint
-        url = f"https://graph.facebook.com/v23.0/{business_portfolio_id}/preverified_numbers"
-        
-        
-        if not ACCESS_TOKEN:
-            return {"error": "ACCESS_TOKEN not found in environment variables"}
-        
-        # Add access token and fields to request parameters
-        params = {
-            "access_token": ACCESS_TOKEN,
-            "fields": "id,phone_number,code_verification_status,verification_expiry_time"
+        ids = [number["id"] for number in numbers if number.get("id")]
+        # Numbers no longer listed by Graph were deleted or moved; drop them
+        db.query(PreverifiedPhoneNumber).filter(
+            PreverifiedPhoneNumber.portfolio_id == portfolio_id,
+            PreverifiedPhoneNumber.id.notin_(ids)
+        ).delete(synchronize_session=False)
+        existing = {
+            record.id: record
+            for record in db.query(PreverifiedPhoneNumber).filter(PreverifiedPhoneNumber.id.in_(ids))
         }
-        
-        # Make the request to Facebook Graph API
-        response = requests.get(url, params=params)
-        
+        for number in numbers:
+            if not number.get("id"):
+                continue
+            record = existing.get(number["id"])
+            if not record:
+                record = PreverifiedPhoneNumber(id=number["id"])
+                db.add(record)
+            record.portfolio_id = portfolio_id
+            record.phone_number = number.get("phone_number", "")
+            record.code_verification_status = number.get("code_verification_status")
+            record.verification_expiry_time = number.get("verification_expiry_time")
+            record.updated_at = datetime.utcnow()
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print(f"Error storing preverified numbers: {str(e)}")
+
+def forget_deleted_phone_numbers(db: Session, number_ids: List[str]):
+    """Drop stored rows for numbers deleted on Graph, returns how many rows were removed"""
+    try:
+        removed = db.query(WabaPhoneNumber).filter(
+            WabaPhoneNumber.phone_number_id.in_(number_ids)
+        ).delete(synchronize_session=False)
+        removed += db.query(PreverifiedPhoneNumber).filter(
+            PreverifiedPhoneNumber.id.in_(number_ids)
+        ).delete(synchronize_session=False)
+        db.commit()
+        return removed
+    except Exception as e:
+        db.rollback()
+        print(f"Error removing stored phone numbers: {str(e)}")
+        return 0
+
+def with_session(work, *args):
+    """Run work(db, *args) in a short-lived session; async endpoints call this via asyncio.to_thread"""
+    db = SessionLocal()
+    try:
+        return work(db, *args)
+    finally:
+        db.close()
+
+def waba_ids_for(db: Session, number_ids: List[str]):
+    """phone_number_id -> waba_id for the given numbers that are stored under a WABA"""
+    rows = db.query(WabaPhoneNumber.phone_number_id, WabaPhoneNumber.waba_id).filter(
+        WabaPhoneNumber.phone_number_id.in_(number_ids)
+    ).all()
+    return {phone_number_id: waba_id for phone_number_id, waba_id in rows}
+
+def publish_phone_number_event(event_type: str, number_id: str, **data):
+    """Publish an event tagged with the number's stored WABA, so ?waba_id= subscribers see every type"""
+    waba_id = with_session(waba_ids_for, [number_id]).get(number_id)
+    return phone_number_events.publish(event_type, number_id, waba_id=waba_id, **data)
+
+def lookup_portfolio(portfolio_id: Optional[str]):
+    """Resolve a portfolio with a short-lived session, so no connection is held during Graph calls"""
+    db = SessionLocal()
+    try:
+        return resolve_portfolio(db, portfolio_id, business_portfolio_id, ACCESS_TOKEN)
+    finally:
+        db.close()
+
+def budgeted_passthrough(portfolio: dict, url: str, params: dict, request: Request):
+    """Passthrough GET that keeps the portfolio's budget slot until the body has been streamed"""
+    slot = ExitStack()
+    slot.enter_context(budget_for(portfolio).reserve())
+    try:
+        upstream = graph_client.get(url, params=params, headers=passthrough_request_headers(request), stream=True)
+    except Exception:
+        slot.close()
+        raise
+    return passthrough_response(upstream, on_close=slot.close)
+
+def fetch_all_pages(portfolio: dict, url: str, params: dict):
+    """GET a portfolio listing and every following page within the portfolio's budget, returns (items, error)"""
+    items = []
+    while url:
+        with budget_for(portfolio).reserve():
+            response = graph_client.get(url, params=params)
         if response.status_code != 200:
-            return {
+            return items, {
                 "error": f"Facebook API error: {response.status_code}",
                 "details": response.text,
                 "url": url
             }
-            
-        return response.json()
+        page = response.json()
+        items.extend(page.get("data", []))
+        # The next link already carries the access token and query parameters
+        url, params = page.get("paging", {}).get("next"), None
+    return items, None
+
+def portfolio_resource_request(resource: str, portfolio: dict):
+    """Graph URL and query parameters for a portfolio-level listing"""
+    portfolio_id = portfolio["portfolio_id"]
+    params = {"access_token": portfolio["access_token"]}
+    if resource == "phone-numbers":
+        # Facebook Graph API endpoint - use preverified_numbers endpoint
+        url = f"https://graph.facebook.com/v23.0/{portfolio_id}/preverified_numbers"
+        params["fields"] = "id,phone_number,code_verification_status,verification_expiry_time"
+    elif resource == "wabas":
+        # Facebook Graph API endpoint for owned WhatsApp Business Accounts
+        url = f"https://graph.facebook.com/v23.0/{portfolio_id}/owned_whatsapp_business_accounts"
+    elif resource == "client-wabas":
+        # Facebook Graph API endpoint for client WhatsApp Business Accounts
+        url = f"https://graph.facebook.com/v23.0/{portfolio_id}/client_whatsapp_business_accounts"
+        params["filtering"] = f'[{{"field":"partners","operator":"ALL","value":["{portfolio_id}"]}}]'
+    else:
+        raise ValueError(f"Unknown portfolio resource: {resource}")
+    return url, params
+
+@app.get("/phone-numbers")
+def get_phone_numbers(portfolio_id: Optional[str] = None):
+
+    try:
+        portfolio, error = lookup_portfolio(portfolio_id)
+        if error:
+            return error
+        
+        url, params = portfolio_resource_request("phone-numbers", portfolio)
+        
+        # Make the requests to Facebook Graph API, every page so the stored copy is complete
+        numbers, error = fetch_all_pages(portfolio, url, params)
+        if error:
+            return error
+        
+        with_session(store_preverified_numbers, portfolio["portfolio_id"], numbers)
+        return {"data": numbers}
         
     except Exception as e:
         return {"error": f"Failed to retrieve phone numbers: {str(e)}"}
 
 @app.get("/wabas")
-async def get_wabas():
+def get_wabas(request: Request, portfolio_id: Optional[str] = None, passthrough: bool = GRAPH_PASSTHROUGH):
     try:
-        # Use business portfolio ID from environment variables
-        if not business_portfolio_id:
-            return {"error": "BUSINESS_PORTFOLIO_ID not found in environment variables"}
-            
-        if not ACCESS_TOKEN:
-            return {"error": "ACCESS_TOKEN not found in environment variables"}
+        portfolio, error = lookup_portfolio(portfolio_id)
+        if error:
+            return error
         
-        # Facebook Graph API endpoint for owned WhatsApp Business Accounts
-        url = f"https://graph.facebook.com/v23.0/{business_portfolio_id}/owned_whatsapp_business_accounts"
+        url, params = portfolio_resource_request("wabas", portfolio)
         
-        # Add access token to request parameters
-        params = {
-            "access_token": ACCESS_TOKEN
-        }
+        if passthrough:
+            return budgeted_passthrough(portfolio, url, params, request)
         
         # Make the request to Facebook Graph API
-        response = requests.get(url, params=params)
+        with budget_for(portfolio).reserve():
+            response = graph_client.get(url, params=params)
         
         if response.status_code != 200:
             return {
@@ -127,26 +389,20 @@ async def get_wabas():
         return {"error": f"Failed to retrieve WABAs: {str(e)}"}
 
 @app.get("/client-wabas")
-async def get_client_wabas():
+def get_client_wabas(request: Request, portfolio_id: Optional[str] = None, passthrough: bool = GRAPH_PASSTHROUGH):
     try:
-        # Use business portfolio ID from environment variables
-        if not business_portfolio_id:
-            return {"error": "BUSINESS_PORTFOLIO_ID not found in environment variables"}
-            
-        if not ACCESS_TOKEN:
-            return {"error": "ACCESS_TOKEN not found in environment variables"}
+        portfolio, error = lookup_portfolio(portfolio_id)
+        if error:
+            return error
         
-        # Facebook Graph API endpoint for client WhatsApp Business Accounts
-        url = f"https://graph.facebook.com/v23.0/{business_portfolio_id}/client_whatsapp_business_accounts"
+        url, params = portfolio_resource_request("client-wabas", portfolio)
         
-        # Add access token and filtering to request parameters
-        params = {
-            "access_token": ACCESS_TOKEN,
-            "filtering": f'[{{"field":"partners","operator":"ALL","value":["{business_portfolio_id}"]}}]'
-        }
+        if passthrough:
+            return budgeted_passthrough(portfolio, url, params, request)
         
         # Make the request to Facebook Graph API
-        response = requests.get(url, params=params)
+        with budget_for(portfolio).reserve():
+            response = graph_client.get(url, params=params)
         
         if response.status_code != 200:
             return {
@@ -161,12 +417,114 @@ async def get_client_wabas():
     except Exception as e:
         return {"error": f"Failed to retrieve client WABAs: {str(e)}"}
 
+@app.post("/portfolios")
+def register_portfolio(request: PortfolioRequest, db: Session = Depends(get_db)):
+    """Register or update a business portfolio served by this backend"""
+    try:
+        existing = db.query(BusinessPortfolio).filter(BusinessPortfolio.portfolio_id == request.portfolio_id).first()
+        if existing:
+            existing.name = request.name
+            existing.access_token = request.access_token
+            existing.max_concurrency = request.max_concurrency
+            existing.requests_per_minute = request.requests_per_minute
+            existing.updated_at = datetime.utcnow()
+        else:
+            db.add(BusinessPortfolio(
+                portfolio_id=request.portfolio_id,
+                name=request.name,
+                access_token=request.access_token,
+                max_concurrency=request.max_concurrency,
+                requests_per_minute=request.requests_per_minute
+            ))
+        db.commit()
+        return {"success": True, "portfolio_id": request.portfolio_id}
+    except Exception as e:
+        db.rollback()
+        return {"error": f"Failed to register portfolio: {str(e)}"}
+
+@app.get("/portfolios")
+def get_portfolios(db: Session = Depends(get_db)):
+    """List portfolios with their budgets and current usage"""
+    try:
+        return {
+            "data": [
+                {
+                    "portfolio_id": portfolio["portfolio_id"],
+                    "name": portfolio["name"],
+                    "access_token": portfolio["access_token"][:20] + "...",  # Truncate for security
+                    "budget": budget_for(portfolio).snapshot()
+                }
+                for portfolio in all_portfolios(db, business_portfolio_id, ACCESS_TOKEN)
+            ]
+        }
+    except Exception as e:
+        return {"error": f"Failed to retrieve portfolios: {str(e)}"}
+
+@app.delete("/portfolios/{portfolio_id}")
+def delete_portfolio(portfolio_id: str, db: Session = Depends(get_db)):
+    try:
+        deleted = db.query(BusinessPortfolio).filter(BusinessPortfolio.portfolio_id == portfolio_id).delete()
+        db.commit()
+        if not deleted:
+            return {"error": "Portfolio not found"}
+        return {"success": True, "portfolio_id": portfolio_id}
+    except Exception as e:
+        db.rollback()
+        return {"error": f"Failed to delete portfolio: {str(e)}"}
+
+def fetch_portfolio_resource(resource: str, portfolio: dict):
+    """Blocking fetch of one portfolio listing within that portfolio's budget"""
+    started = time.perf_counter()
+    result = {"portfolio_id": portfolio["portfolio_id"], "name": portfolio["name"]}
+    try:
+        url, params = portfolio_resource_request(resource, portfolio)
+        items, error = fetch_all_pages(portfolio, url, params)
+        if error:
+            result["error"] = error["error"]
+            result["details"] = error["details"]
+        else:
+            result["data"] = items
+            if resource == "phone-numbers":
+                # Same full listing /phone-numbers stores, keep local search current for every portfolio
+                with_session(store_preverified_numbers, portfolio["portfolio_id"], items)
+    except Exception as e:
+        result["error"] = str(e)
+    result["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return result
+
+@app.get("/all-portfolios/{resource}")
+async def get_all_portfolios_resource(resource: str):
+    """phone-numbers, wabas or client-wabas merged across every portfolio, fetched in parallel"""
+    if resource not in ("phone-numbers", "wabas", "client-wabas"):
+        return {"error": "resource must be one of phone-numbers, wabas, client-wabas"}
+    try:
+        # Don't hold a pooled connection while the fan-out waits on Graph
+        portfolios = await asyncio.to_thread(with_session, all_portfolios, business_portfolio_id, ACCESS_TOKEN)
+        results = await asyncio.gather(*(
+            asyncio.to_thread(fetch_portfolio_resource, resource, portfolio) for portfolio in portfolios
+        ))
+        return {
+            # Each item is tagged with the portfolio it came from
+            "data": [
+                {**item, "portfolio_id": result["portfolio_id"]}
+                for result in results
+                for item in result.get("data", [])
+            ],
+            "portfolios": [
+                {key: value for key, value in result.items() if key != "data"} for result in results
+            ]
+        }
+    except Exception as e:
+        return {"error": f"Failed to retrieve {resource} across portfolios: {str(e)}"}
+
 @app.get("/waba-phone-numbers/{waba_id}")
-async def get_waba_phone_numbers(waba_id: str, db: Session = Depends(get_db)):
+def get_waba_phone_numbers(waba_id: str, db: Session = Depends(get_db)):
     try:
         # Try to get business token from database first
         waba_data = db.query(WabaData).filter(WabaData.waba_id == waba_id).first()
-        access_token = waba_data.access_token if waba_data else ACCESS_TOKEN
+        access_token, token_error = resolve_waba_token(waba_data, ACCESS_TOKEN)
+        if token_error:
+            return token_error
         
         if not access_token:
             return {"error": "No access token available"}
@@ -180,7 +538,7 @@ async def get_waba_phone_numbers(waba_id: str, db: Session = Depends(get_db)):
         }
         
         # Make the request to Facebook Graph API
-        response = requests.get(url, params=params)
+        response = graph_client.get(url, params=params)
         
         if response.status_code != 200:
             return {
@@ -238,7 +596,7 @@ async def get_waba_phone_numbers(waba_id: str, db: Session = Depends(get_db)):
         return {"error": f"Failed to retrieve WABA phone numbers: {str(e)}"}
 
 @app.post("/add-phone-number")
-async def add_phone_number(request: PhoneNumberRequest):
+def add_phone_number(request: PhoneNumberRequest, portfolio_id: Optional[str] = None):
     try:
         print(f"\n=== Add Phone Number Endpoint Called ===")
         print(f"Request received: {request}")
@@ -246,17 +604,13 @@ async def add_phone_number(request: PhoneNumberRequest):
         print(f"Phone number extracted: {phone_number}")
         print(f"=== Adding Phone Number: {phone_number} ===")
         
-        # Use business portfolio ID from environment variables
-        if not business_portfolio_id:
-            print("BUSINESS_PORTFOLIO_ID not found in environment variables")
-            return {"error": "BUSINESS_PORTFOLIO_ID not found in environment variables"}
-            
-        if not ACCESS_TOKEN:
-            print("ACCESS_TOKEN not found in environment variables")
-            return {"error": "ACCESS_TOKEN not found in environment variables"}
+        portfolio, error = lookup_portfolio(portfolio_id)
+        if error:
+            print(error["error"])
+            return error
         
         # Facebook Graph API endpoint for adding phone numbers
-        url = f"https://graph.facebook.com/v23.0/{business_portfolio_id}/add_phone_numbers"
+        url = f"https://graph.facebook.com/v23.0/{portfolio['portfolio_id']}/add_phone_numbers"
         print(f"Calling Facebook API: {url}")
         
         # Prepare the request data
@@ -267,11 +621,12 @@ async def add_phone_number(request: PhoneNumberRequest):
         
         # Add access token to request parameters
         params = {
-            "access_token": ACCESS_TOKEN
+            "access_token": portfolio["access_token"]
         }
         
         # Make the POST request to Facebook Graph API
-        response = requests.post(url, json=data, params=params)
+        with budget_for(portfolio).reserve():
+            response = graph_client.post(url, json=data, params=params)
         
         print(f"Response Status Code: {response.status_code}")
         print(f"Response Headers: {dict(response.headers)}")
@@ -289,6 +644,13 @@ async def add_phone_number(request: PhoneNumberRequest):
         print(f"Success: Phone number added successfully")
         print(f"Response data: {response_data}")
         print("=" * 50)
+        
+        publish_phone_number_event(
+            PHONE_NUMBER_ADDED,
+            response_data.get("id"),
+            phone_number=phone_number,
+            portfolio_id=portfolio["portfolio_id"]
+        )
             
         return response_data
         
@@ -297,7 +659,7 @@ async def add_phone_number(request: PhoneNumberRequest):
         return {"error": f"Failed to add phone number: {str(e)}"}
 
 @app.delete("/delete-phone-number/{number_id}")
-async def delete_phone_number(number_id: str):
+def delete_phone_number(number_id: str, request: Request, passthrough: bool = GRAPH_PASSTHROUGH, db: Session = Depends(get_db)):
     try:
         if not ACCESS_TOKEN:
             return {"error": "ACCESS_TOKEN not found in environment variables"}
@@ -310,8 +672,17 @@ async def delete_phone_number(number_id: str):
             "access_token": ACCESS_TOKEN
         }
         
+        if passthrough:
+            response = graph_client.delete(url, params=params, headers=passthrough_request_headers(request), stream=True)
+            if response.status_code == 200:
+                # Look the WABA up before the stored row is dropped
+                waba_id = waba_ids_for(db, [number_id]).get(number_id)
+                forget_deleted_phone_numbers(db, [number_id])
+                phone_number_events.publish(PHONE_NUMBER_DELETED, number_id, waba_id=waba_id)
+            return passthrough_response(response)
+        
         # Make the DELETE request to Facebook Graph API
-        response = requests.delete(url, params=params)
+        response = graph_client.delete(url, params=params)
         
         if response.status_code != 200:
             return {
@@ -319,14 +690,17 @@ async def delete_phone_number(number_id: str):
                 "details": response.text,
                 "url": url
             }
-            
+        
+        waba_id = waba_ids_for(db, [number_id]).get(number_id)
+        forget_deleted_phone_numbers(db, [number_id])
+        phone_number_events.publish(PHONE_NUMBER_DELETED, number_id, waba_id=waba_id)
         return response.json()
         
     except Exception as e:
         return {"error": f"Failed to delete phone number: {str(e)}"}
 
 @app.post("/request-verification-code/{number_id}")
-async def request_verification_code(number_id: str):
+def request_verification_code(number_id: str):
     try:
         print(f"\n=== Requesting Verification Code for Phone Number ID: {number_id} ===")
         
@@ -342,7 +716,7 @@ async def request_verification_code(number_id: str):
         }
         
         print(f"Getting phone number details from: {phone_details_url}")
-        phone_response = requests.get(phone_details_url, params=phone_params)
+        phone_response = graph_client.get(phone_details_url, params=phone_params)
         
         if phone_response.status_code == 200:
             phone_data = phone_response.json()
@@ -365,7 +739,7 @@ async def request_verification_code(number_id: str):
         print(f"Request parameters: {params}")
         
         # Make the POST request to Facebook Graph API
-        response = requests.post(url, params=params)
+        response = graph_client.post(url, params=params)
         
         print(f"Response Status Code: {response.status_code}")
         print(f"Response Headers: {dict(response.headers)}")
@@ -383,6 +757,8 @@ async def request_verification_code(number_id: str):
         print(f"Success: Verification code requested successfully")
         print(f"Response data: {response_data}")
         print("=" * 50)
+        
+        publish_phone_number_event(PHONE_NUMBER_CODE_REQUESTED, number_id, code_method="SMS")
             
         return response_data
         
@@ -391,7 +767,7 @@ async def request_verification_code(number_id: str):
         return {"error": f"Failed to request verification code: {str(e)}"}
 
 @app.post("/verify-code/{number_id}")
-async def verify_code(number_id: str, code: str):
+def verify_code(number_id: str, code: str):
     try:
         print(f"\n=== Verifying Code for Phone Number ID: {number_id} ===")
         print(f"Verification Code: {code}")
@@ -412,7 +788,7 @@ async def verify_code(number_id: str, code: str):
         print(f"Request parameters: {params}")
         
         # Make the POST request to Facebook Graph API
-        response = requests.post(url, params=params)
+        response = graph_client.post(url, params=params)
         
         print(f"Response Status Code: {response.status_code}")
         print(f"Response Headers: {dict(response.headers)}")
@@ -432,6 +808,8 @@ async def verify_code(number_id: str, code: str):
         print(f"Success: Code verified successfully")
         print(f"Response data: {response_data}")
         print("=" * 50)
+        
+        publish_phone_number_event(PHONE_NUMBER_VERIFIED, number_id, code_verification_status="VERIFIED")
             
         return response_data
         
@@ -443,7 +821,7 @@ async def verify_code(number_id: str, code: str):
         return {"error": f"Failed to verify code: {str(e)}"}
 
 @app.post("/register-phone-number/{waba_phone_number_id}")
-async def register_phone_number(waba_phone_number_id: str, request: RegisterPhoneRequest, db: Session = Depends(get_db)):
+def register_phone_number(waba_phone_number_id: str, request: RegisterPhoneRequest, db: Session = Depends(get_db)):
     try:
         print(f"\n=== Register Phone Number Endpoint Called ===")
         print(f"WABA Phone Number ID: {waba_phone_number_id}")
@@ -463,7 +841,10 @@ async def register_phone_number(waba_phone_number_id: str, request: RegisterPhon
         if phone_record:
             # We found the WABA, try to use its business token
             waba_data = db.query(WabaData).filter(WabaData.waba_id == phone_record.waba_id).first()
-            access_token = waba_data.access_token if waba_data else ACCESS_TOKEN
+            access_token, token_error = resolve_waba_token(waba_data, ACCESS_TOKEN)
+            if token_error:
+                print(f"ERROR: {token_error['error']}")
+                return token_error
             print(f"Using business token for WABA {phone_record.waba_id} to register phone {waba_phone_number_id}")
             print(f"WABA data found: {waba_data is not None}")
         else:
@@ -497,7 +878,7 @@ async def register_phone_number(waba_phone_number_id: str, request: RegisterPhon
         
         # Make the POST request to Facebook Graph API
         print(f"Making POST request to Facebook API...")
-        response = requests.post(url, json=request_body, params=params)
+        response = graph_client.post(url, json=request_body, params=params)
         
         print(f"Response Status Code: {response.status_code}")
         print(f"Response Headers: {dict(response.headers)}")
@@ -517,6 +898,12 @@ async def register_phone_number(waba_phone_number_id: str, request: RegisterPhon
         print(f"Success: Phone number registered successfully")
         print(f"Response data: {response_data}")
         print("=" * 50)
+        
+        phone_number_events.publish(
+            PHONE_NUMBER_REGISTERED,
+            waba_phone_number_id,
+            waba_id=phone_record.waba_id if phone_record else None
+        )
             
         return response_data
         
@@ -528,11 +915,13 @@ async def register_phone_number(waba_phone_number_id: str, request: RegisterPhon
         return {"error": f"Failed to register phone number: {str(e)}"}
 
 @app.post("/subscribe-webhooks/{waba_id}")
-async def subscribe_webhooks(waba_id: str, db: Session = Depends(get_db)):
+def subscribe_webhooks(waba_id: str, db: Session = Depends(get_db)):
     try:
         # Try to get business token from database first
         waba_data = db.query(WabaData).filter(WabaData.waba_id == waba_id).first()
-        access_token = waba_data.access_token if waba_data else ACCESS_TOKEN
+        access_token, token_error = resolve_waba_token(waba_data, ACCESS_TOKEN)
+        if token_error:
+            return token_error
         
         if not access_token:
             return {"error": "No access token available"}
@@ -546,7 +935,7 @@ async def subscribe_webhooks(waba_id: str, db: Session = Depends(get_db)):
         }
         
         # Make the POST request to Facebook Graph API
-        response = requests.post(url, params=params)
+        response = graph_client.post(url, params=params)
         
         # Print response for testing
         print(f"Subscribe webhooks response for WABA {waba_id}:")
@@ -567,13 +956,15 @@ async def subscribe_webhooks(waba_id: str, db: Session = Depends(get_db)):
         return {"error": f"Failed to subscribe to webhooks: {str(e)}"}
 
 @app.get("/waba-subscriptions/{waba_id}")
-async def get_waba_subscriptions(waba_id: str, db: Session = Depends(get_db)):
+def get_waba_subscriptions(waba_id: str, request: Request, passthrough: bool = GRAPH_PASSTHROUGH, db: Session = Depends(get_db)):
     try:
         print(f"GET /waba-subscriptions/{waba_id} called")
         
         # Try to get business token from database first
         waba_data = db.query(WabaData).filter(WabaData.waba_id == waba_id).first()
-        access_token = waba_data.access_token if waba_data else ACCESS_TOKEN
+        access_token, token_error = resolve_waba_token(waba_data, ACCESS_TOKEN)
+        if token_error:
+            return token_error
         
         if not access_token:
             print("No access token available")
@@ -588,8 +979,13 @@ async def get_waba_subscriptions(waba_id: str, db: Session = Depends(get_db)):
             "access_token": access_token
         }
         
+        if passthrough:
+            return passthrough_response(
+                graph_client.get(url, params=params, headers=passthrough_request_headers(request), stream=True)
+            )
+        
         # Make the GET request to Facebook Graph API
-        response = requests.get(url, params=params)
+        response = graph_client.get(url, params=params)
         
         print(f"Facebook API response status: {response.status_code}")
         print(f"Facebook API response body: {response.text}")
@@ -623,8 +1019,16 @@ async def get_waba_subscriptions(waba_id: str, db: Session = Depends(get_db)):
         return {"error": f"Failed to retrieve WABA subscriptions: {str(e)}"}
 
 
+def reset_token_health(waba_data: WabaData):
+    # A new token hasn't been checked yet; don't let the old token's state short-circuit it
+    waba_data.token_is_valid = None
+    waba_data.token_expires_at = None
+    waba_data.token_scopes = None
+    waba_data.token_error = None
+    waba_data.token_checked_at = None
+
 @app.post("/exchange-code-for-token")
-async def exchange_code_for_token(request: WabaRequest, db: Session = Depends(get_db)):
+def exchange_code_for_token(request: WabaRequest, db: Session = Depends(get_db)):
     try:
         if not FACEBOOK_APP_ID or not FACEBOOK_APP_SECRET:
             return {"error": "FACEBOOK_APP_ID or FACEBOOK_APP_SECRET not found in environment variables"}
@@ -638,7 +1042,7 @@ async def exchange_code_for_token(request: WabaRequest, db: Session = Depends(ge
         }
         
         print(f"Exchanging code for token with params: {params}")
-        response = requests.get(url, params=params)
+        response = graph_client.get(url, params=params)
         
         print(f"Facebook API response status: {response.status_code}")
         print(f"Facebook API response body: {response.text}")
@@ -668,6 +1072,7 @@ async def exchange_code_for_token(request: WabaRequest, db: Session = Depends(ge
                 existing_waba = db.query(WabaData).filter(WabaData.waba_id == request.waba_id).first()
                 if existing_waba:
                     existing_waba.access_token = business_token
+                    reset_token_health(existing_waba)
                     existing_waba.updated_at = datetime.utcnow()
                     print(f"Updated existing WABA data: {request.waba_id}")
                 else:
@@ -698,6 +1103,7 @@ async def exchange_code_for_token(request: WabaRequest, db: Session = Depends(ge
                 existing_waba = db.query(WabaData).filter(WabaData.waba_id == request.waba_id).first()
                 if existing_waba:
                     existing_waba.access_token = business_token
+                    reset_token_health(existing_waba)
                     existing_waba.updated_at = datetime.utcnow()
                 else:
                     db.add(waba_data)
@@ -725,8 +1131,45 @@ async def exchange_code_for_token(request: WabaRequest, db: Session = Depends(ge
         print(f"Exception in exchange_code_for_token: {str(e)}")
         return {"error": f"Failed to exchange code for token: {str(e)}"}
 
+@app.get("/expiring-tokens")
+def get_expiring_tokens(within_hours: float = 168, db: Session = Depends(get_db)):
+    """Stored WABA tokens that are invalid or expire within the given number of hours"""
+    try:
+        cutoff = datetime.utcnow() + timedelta(hours=within_hours)
+        wabas = db.query(WabaData).filter(
+            or_(WabaData.token_is_valid.is_(False), WabaData.token_expires_at <= cutoff)
+        ).order_by(WabaData.token_expires_at).all()
+        return {
+            "within_hours": within_hours,
+            "data": [
+                {
+                    "waba_id": waba.waba_id,
+                    "token_is_valid": waba.token_is_valid,
+                    "token_expires_at": waba.token_expires_at.isoformat() if waba.token_expires_at else None,
+                    "token_scopes": waba.token_scopes.split(",") if waba.token_scopes else [],
+                    "token_error": waba.token_error,
+                    "token_checked_at": waba.token_checked_at.isoformat() if waba.token_checked_at else None,
+                    "problem": token_problem(waba)
+                }
+                for waba in wabas
+            ]
+        }
+    except Exception as e:
+        return {"error": f"Failed to retrieve expiring tokens: {str(e)}"}
+
+@app.post("/check-tokens")
+async def check_tokens_now():
+    """Run the token health check immediately instead of waiting for the next scheduled run"""
+    try:
+        if not FACEBOOK_APP_ID or not FACEBOOK_APP_SECRET:
+            return {"error": "FACEBOOK_APP_ID or FACEBOOK_APP_SECRET not found in environment variables"}
+        checked = await asyncio.to_thread(check_stored_tokens, FACEBOOK_APP_ID, FACEBOOK_APP_SECRET)
+        return {"success": True, "checked": checked}
+    except Exception as e:
+        return {"error": f"Failed to check tokens: {str(e)}"}
+
 @app.get("/waba-data")
-async def get_waba_data(db: Session = Depends(get_db)):
+def get_waba_data(db: Session = Depends(get_db)):
     """Get all stored WABA data"""
     try:
         waba_data = db.query(WabaData).all()
@@ -745,7 +1188,7 @@ async def get_waba_data(db: Session = Depends(get_db)):
         return {"error": f"Failed to retrieve WABA data: {str(e)}"}
 
 @app.get("/waba-data/{waba_id}")
-async def get_waba_data_by_id(waba_id: str, db: Session = Depends(get_db)):
+def get_waba_data_by_id(waba_id: str, db: Session = Depends(get_db)):
     """Get specific WABA data by ID"""
     try:
         waba_data = db.query(WabaData).filter(WabaData.waba_id == waba_id).first()
@@ -762,7 +1205,7 @@ async def get_waba_data_by_id(waba_id: str, db: Session = Depends(get_db)):
         return {"error": f"Failed to retrieve WABA data: {str(e)}"}
 
 @app.get("/waba-data/{waba_id}/with-phone-numbers")
-async def get_waba_data_with_phone_numbers(waba_id: str, db: Session = Depends(get_db)):
+def get_waba_data_with_phone_numbers(waba_id: str, db: Session = Depends(get_db)):
     """Get WABA data with associated phone numbers"""
     try:
         waba_data = db.query(WabaData).filter(WabaData.waba_id == waba_id).first()
@@ -793,7 +1236,7 @@ async def get_waba_data_with_phone_numbers(waba_id: str, db: Session = Depends(g
         return {"error": f"Failed to retrieve WABA data with phone numbers: {str(e)}"}
 
 @app.get("/stored-phone-numbers/{waba_id}")
-async def get_stored_phone_numbers(waba_id: str, db: Session = Depends(get_db)):
+def get_stored_phone_numbers(waba_id: str, db: Session = Depends(get_db)):
     """Get stored phone numbers for a specific WABA"""
     try:
         phone_numbers = db.query(WabaPhoneNumber).filter(WabaPhoneNumber.waba_id == waba_id).all()
@@ -816,7 +1259,7 @@ async def get_stored_phone_numbers(waba_id: str, db: Session = Depends(get_db)):
         return {"error": f"Failed to retrieve stored phone numbers: {str(e)}"}
 
 @app.get("/all-stored-phone-numbers")
-async def get_all_stored_phone_numbers(db: Session = Depends(get_db)):
+def get_all_stored_phone_numbers(db: Session = Depends(get_db)):
     """Get all stored phone numbers across all WABAs"""
     try:
         phone_numbers = db.query(WabaPhoneNumber).all()
@@ -838,9 +1281,326 @@ async def get_all_stored_phone_numbers(db: Session = Depends(get_db)):
     except Exception as e:
         return {"error": f"Failed to retrieve all stored phone numbers: {str(e)}"}
 
+def digit_prefix_filter(column, prefix: str):
+    """Prefix match on a digits-only column as an index range scan: prefix <= column < next prefix"""
+    conditions = [column >= prefix]
+    # "4479" -> "448", "4499" -> "45"; an all-9s prefix has no upper bound
+    stem = prefix.rstrip("9")
+    if stem:
+        conditions.append(column < stem[:-1] + str(int(stem[-1]) + 1))
+    return and_(*conditions)
+
+@app.get("/search-phone-numbers")
+def search_phone_numbers(
+    q: str,
+    match: str = "prefix",
+    source: str = "all",
+    limit: int = 50,
+    db: Session = Depends(get_db)
+):
+    """Find stored WABA numbers and preverified numbers by E.164 digits (prefix, suffix or exact match)"""
+    try:
+        if match not in ("prefix", "suffix", "exact"):
+            return {"error": "match must be one of prefix, suffix, exact"}
+        if source not in ("all", "stored", "preverified"):
+            return {"error": "source must be one of all, stored, preverified"}
+        
+        # Prefix and exact queries are normalized like stored numbers (0044... == +44...);
+        # a suffix query is the tail of a number, so a leading 00 there is real digits
+        digits = phone_number_digits(q) if match == "suffix" else normalize_phone_number(q)
+        if not digits:
+            return {"error": "Search query must contain digits"}
+        limit = max(1, min(limit, 500))
+        
+        def number_filter(model):
+            if match == "exact":
+                return model.normalized_phone_number == digits
+            if match == "suffix":
+                return digit_prefix_filter(model.reversed_phone_number, digits[::-1])
+            return digit_prefix_filter(model.normalized_phone_number, digits)
+        
+        results = []
+        if source in ("all", "stored"):
+            phones = db.query(WabaPhoneNumber).filter(number_filter(WabaPhoneNumber)).order_by(
+                WabaPhoneNumber.normalized_phone_number
+            ).limit(limit).all()
+            results.extend(
+                {
+                    "source": "stored",
+                    "phone_number_id": phone.phone_number_id,
+                    "waba_id": phone.waba_id,
+                    "display_phone_number": phone.display_phone_number,
+                    "normalized_phone_number": phone.normalized_phone_number,
+                    "code_verification_status": phone.code_verification_status,
+                    "verification_expiry_time": phone.verification_expiry_time
+                }
+                for phone in phones
+            )
+        if source in ("all", "preverified"):
+            numbers = db.query(PreverifiedPhoneNumber).filter(number_filter(PreverifiedPhoneNumber)).order_by(
+                PreverifiedPhoneNumber.normalized_phone_number
+            ).limit(limit).all()
+            results.extend(
+                {
+                    "source": "preverified",
+                    "phone_number_id": number.id,
+                    "portfolio_id": number.portfolio_id,
+                    "display_phone_number": number.phone_number,
+                    "normalized_phone_number": number.normalized_phone_number,
+                    "code_verification_status": number.code_verification_status,
+                    "verification_expiry_time": number.verification_expiry_time
+                }
+                for number in numbers
+            )
+        
+        results.sort(key=lambda result: result["normalized_phone_number"])
+        return {"query": digits, "match": match, "data": results[:limit]}
+    except Exception as e:
+        return {"error": f"Failed to search phone numbers: {str(e)}"}
+
+# Columns included in /export; access tokens are deliberately left out
+EXPORT_COLUMNS = [
+    ("waba_id", WabaData.waba_id),
+    ("waba_created_at", WabaData.created_at),
+    ("waba_updated_at", WabaData.updated_at),
+    ("phone_number_id", WabaPhoneNumber.phone_number_id),
+    ("display_phone_number", WabaPhoneNumber.display_phone_number),
+    ("code_verification_status", WabaPhoneNumber.code_verification_status),
+    ("verification_expiry_time", WabaPhoneNumber.verification_expiry_time),
+    ("phone_created_at", WabaPhoneNumber.created_at),
+    ("phone_updated_at", WabaPhoneNumber.updated_at),
+]
+
+def export_rows(waba_id: Optional[str] = None):
+    """Yield batches of WABA/phone rows from a server-side cursor, never holding the full result"""
+    query = (
+        select(*[column for _, column in EXPORT_COLUMNS])
+        .select_from(WabaData)
+        .outerjoin(WabaPhoneNumber, WabaPhoneNumber.waba_id == WabaData.waba_id)
+        .order_by(WabaData.waba_id, WabaPhoneNumber.id)
+    )
+    if waba_id:
+        query = query.where(WabaData.waba_id == waba_id)
+    
+    db = SessionLocal()
+    try:
+        result = db.execute(query.execution_options(stream_results=True, yield_per=EXPORT_BATCH_SIZE))
+        for batch in result.partitions():
+            yield [
+                [value.isoformat() if isinstance(value, datetime) else value for value in row]
+                for row in batch
+            ]
+    finally:
+        db.close()
+
+def export_ndjson(waba_id: Optional[str] = None):
+    names = [name for name, _ in EXPORT_COLUMNS]
+    for batch in export_rows(waba_id):
+        yield "".join(json.dumps(dict(zip(names, row))) + "\n" for row in batch)
+
+def export_csv(waba_id: Optional[str] = None):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([name for name, _ in EXPORT_COLUMNS])
+    for batch in export_rows(waba_id):
+        writer.writerows(batch)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # Header only, when there are no rows at all
+    if buffer.tell():
+        yield buffer.getvalue()
+
+@app.get("/export")
+async def export_waba_data(format: str = "ndjson", waba_id: Optional[str] = None):
+    """Stream stored WABAs joined with their phone numbers as NDJSON or CSV"""
+    if format == "ndjson":
+        body, media_type = export_ndjson(waba_id), "application/x-ndjson"
+    elif format == "csv":
+        body, media_type = export_csv(waba_id), "text/csv"
+    else:
+        return {"error": "format must be 'ndjson' or 'csv'"}
+    
+    filename = f"waba-export-{datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')}.{format}"
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@app.get("/phone-number-events")
+async def stream_phone_number_events(
+    request: Request,
+    phone_number_id: Optional[str] = None,
+    waba_id: Optional[str] = None,
+    last_event_id: Optional[str] = Header(None)
+):
+    """Server-Sent Events stream of phone number status changes (added, code requested, verified, registered, deleted)"""
+
+    def matches(event):
+        if phone_number_id and event.get("phone_number_id") != phone_number_id:
+            return False
+        if waba_id and event.get("waba_id") != waba_id:
+            return False
+        return True
+
+    async def event_stream():
+        queue = phone_number_events.subscribe()
+        try:
+            # Replay anything the client missed since its last received event
+            replayed_up_to = 0
+            if last_event_id and last_event_id.isdigit():
+                for event in phone_number_events.events_since(int(last_event_id)):
+                    replayed_up_to = event["id"]
+                    if matches(event):
+                        yield format_sse(event)
+            
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=SSE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                
+                # We subscribed before replaying, so the queue may repeat replayed events
+                if event["id"] > replayed_up_to and matches(event):
+                    yield format_sse(event)
+        finally:
+            phone_number_events.unsubscribe(queue)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def fetch_waba_resource(waba_id: str, resource: str, access_token: str):
+    """Blocking GET of a WABA edge (phone_numbers, subscribed_apps), returns (payload, error, elapsed_ms)"""
+    started = time.perf_counter()
+    url = f"https://graph.facebook.com/v23.0/{waba_id}/{resource}"
+    try:
+        response = graph_client.get(url, params={"access_token": access_token})
+        elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+        if response.status_code != 200:
+            return None, {
+                "error": f"Facebook API error: {response.status_code}",
+                "details": response.text,
+                "url": url
+            }, elapsed_ms
+        return response.json(), None, elapsed_ms
+    except Exception as e:
+        elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+        error = {"error": f"Failed to retrieve {resource}: {str(e)}", "url": url}
+        remaining = graph_client.deadline_remaining()
+        if remaining is not None and remaining <= 0:
+            # Cut short by the request deadline rather than failed by Graph
+            error["deadline_exceeded"] = True
+        return None, error, elapsed_ms
+
+async def fetch_waba_overview(waba_id: str, access_token: str, semaphore: asyncio.Semaphore):
+    async with semaphore:
+        started = time.perf_counter()
+        (phones, phones_error, phones_ms), (subscriptions, subscriptions_error, subscriptions_ms) = await asyncio.gather(
+            asyncio.to_thread(fetch_waba_resource, waba_id, "phone_numbers", access_token),
+            asyncio.to_thread(fetch_waba_resource, waba_id, "subscribed_apps", access_token)
+        )
+        errors = {
+            key: error for key, error in (("phone_numbers", phones_error), ("subscriptions", subscriptions_error)) if error
+        }
+        if any(error.get("deadline_exceeded") for error in errors.values()):
+            status = "timeout"
+        else:
+            status = "ok" if not errors else ("error" if len(errors) == 2 else "partial")
+        return {
+            "waba_id": waba_id,
+            "status": status,
+            "phone_numbers": phones.get("data", []) if phones else None,
+            "subscriptions": subscriptions.get("data", []) if subscriptions else None,
+            "errors": errors or None,
+            "timings_ms": {
+                "total": round((time.perf_counter() - started) * 1000, 1),
+                "phone_numbers": phones_ms,
+                "subscriptions": subscriptions_ms
+            }
+        }
+
+def fleet_wabas(db: Session):
+    """(waba_id, access_token, token_error) for every stored WABA"""
+    wabas = []
+    for waba in db.query(WabaData).all():
+        access_token, token_error = resolve_waba_token(waba, ACCESS_TOKEN)
+        wabas.append((waba.waba_id, access_token, token_error))
+    return wabas
+
+@app.get("/fleet-overview")
+async def get_fleet_overview(
+    max_concurrency: int = FLEET_MAX_CONCURRENCY,
+    deadline_seconds: float = FLEET_DEADLINE_SECONDS
+):
+    """Phone numbers and webhook subscriptions for every stored WABA, fetched concurrently"""
+    try:
+        started = time.perf_counter()
+        # Callers may ask for less than the configured limits, never more; the fan-out
+        # also has to finish inside the request deadline its Graph calls are held to
+        max_concurrency = min(max_concurrency, FLEET_MAX_CONCURRENCY)
+        deadline_seconds = min(deadline_seconds, REQUEST_DEADLINE_SECONDS)
+        remaining = graph_client.deadline_remaining()
+        if remaining is not None:
+            deadline_seconds = min(deadline_seconds, remaining)
+        wabas = await asyncio.to_thread(with_session, fleet_wabas)
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+        
+        results = {}
+        tasks = {}
+        for waba_id, access_token, token_error in wabas:
+            if token_error or not access_token:
+                # Known-bad tokens are reported without a Graph round trip
+                error = token_error["error"] if token_error else "No access token available"
+                results[waba_id] = {"waba_id": waba_id, "status": "error", "errors": {"token": error}}
+                continue
+            tasks[asyncio.create_task(fetch_waba_overview(waba_id, access_token, semaphore))] = waba_id
+        
+        if tasks:
+            done, pending = await asyncio.wait(tasks.keys(), timeout=max(0.0, deadline_seconds))
+            for task in done:
+                results[tasks[task]] = task.result()
+            for task in pending:
+                # Blocking calls already in flight finish in their threads; their results are discarded
+                task.cancel()
+                results[tasks[task]] = {
+                    "waba_id": tasks[task],
+                    "status": "timeout",
+                    "errors": {"deadline": f"No response within {deadline_seconds}s"},
+                    "timings_ms": {"total": round((time.perf_counter() - started) * 1000, 1)}
+                }
+        
+        # Aggregate verification statuses across every number we did get back
+        status_counts = {}
+        for result in results.values():
+            for phone in result.get("phone_numbers") or []:
+                status = phone.get("code_verification_status") or "UNKNOWN"
+                status_counts[status] = status_counts.get(status, 0) + 1
+        
+        waba_statuses = [result["status"] for result in results.values()]
+        return {
+            "summary": {
+                "waba_count": len(wabas),
+                "ok": waba_statuses.count("ok"),
+                "partial": waba_statuses.count("partial"),
+                "failed": waba_statuses.count("error"),
+                "timed_out": waba_statuses.count("timeout"),
+                "phone_number_count": sum(status_counts.values()),
+                "verification_status_counts": status_counts,
+                "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)
+            },
+            "wabas": [results[waba_id] for waba_id, _, _ in wabas]
+        }
+    except Exception as e:
+        return {"error": f"Failed to build fleet overview: {str(e)}"}
+
 # not being used
 @app.post("/deregister-phone-number/{number_id}")
-async def deregister_phone_number(number_id: str):
+def deregister_phone_number(number_id: str):
     try:
         if not ACCESS_TOKEN:
             return {"error": "ACCESS_TOKEN not found in environment variables"}
@@ -854,7 +1614,7 @@ async def deregister_phone_number(number_id: str):
         }
         
         # Make the POST request to Facebook Graph API
-        response = requests.post(url, params=params)
+        response = graph_client.post(url, params=params)
         
         if response.status_code != 200:
             return {
@@ -862,12 +1622,101 @@ async def deregister_phone_number(number_id: str):
                 "details": response.text,
                 "url": url
             }
-            
+        
+        publish_phone_number_event(PHONE_NUMBER_DEREGISTERED, number_id)
         return response.json()
         
     except Exception as e:
         return {"error": f"Failed to deregister phone number: {str(e)}"}
 
+
+def run_phone_number_action(method: str, number_id: str, edge: str = ""):
+    """Blocking Graph call on one phone number node, returns its per-ID outcome"""
+    url = f"https://graph.facebook.com/v23.0/{number_id}{edge}"
+    try:
+        response = graph_client.request(method, url, params={"access_token": ACCESS_TOKEN})
+        if response.status_code != 200:
+            return {
+                "number_id": number_id,
+                "success": False,
+                "error": f"Facebook API error: {response.status_code}",
+                "details": response.text
+            }
+        return {"number_id": number_id, "success": True, "response": response.json()}
+    except Exception as e:
+        return {"number_id": number_id, "success": False, "error": str(e)}
+
+async def run_bulk_phone_number_action(number_ids: List[str], method: str, edge: str, max_concurrency: int):
+    # Callers may ask for less parallelism than BULK_MAX_CONCURRENCY, never more
+    semaphore = asyncio.Semaphore(max(1, min(max_concurrency, BULK_MAX_CONCURRENCY)))
+
+    async def run_one(number_id):
+        async with semaphore:
+            return await asyncio.to_thread(run_phone_number_action, method, number_id, edge)
+
+    # Drop duplicate IDs but keep the caller's ordering in the results
+    unique_ids = list(dict.fromkeys(number_ids))
+    return await asyncio.gather(*(run_one(number_id) for number_id in unique_ids))
+
+@app.post("/bulk-delete-phone-numbers")
+async def bulk_delete_phone_numbers(
+    request: BulkPhoneNumbersRequest,
+    max_concurrency: int = BULK_MAX_CONCURRENCY
+):
+    """Delete many phone numbers concurrently and drop their stored rows"""
+    try:
+        if not ACCESS_TOKEN:
+            return {"error": "ACCESS_TOKEN not found in environment variables"}
+        if len(request.number_ids) > BULK_MAX_IDS:
+            return {"error": f"At most {BULK_MAX_IDS} phone number IDs can be deleted per request"}
+        
+        results = await run_bulk_phone_number_action(request.number_ids, "DELETE", "", max_concurrency)
+        deleted_ids = [result["number_id"] for result in results if result["success"]]
+        
+        waba_ids, removed_rows = {}, 0
+        if deleted_ids:
+            # Look the WABAs up before the stored rows are dropped
+            waba_ids = await asyncio.to_thread(with_session, waba_ids_for, deleted_ids)
+            removed_rows = await asyncio.to_thread(with_session, forget_deleted_phone_numbers, deleted_ids)
+        
+        for number_id in deleted_ids:
+            phone_number_events.publish(PHONE_NUMBER_DELETED, number_id, waba_id=waba_ids.get(number_id))
+        
+        return {
+            "requested": len(results),
+            "succeeded": len(deleted_ids),
+            "failed": len(results) - len(deleted_ids),
+            "removed_stored_rows": removed_rows,
+            "results": results
+        }
+    except Exception as e:
+        return {"error": f"Failed to bulk delete phone numbers: {str(e)}"}
+
+@app.post("/bulk-deregister-phone-numbers")
+async def bulk_deregister_phone_numbers(request: BulkPhoneNumbersRequest, max_concurrency: int = BULK_MAX_CONCURRENCY):
+    """Deregister many phone numbers concurrently"""
+    try:
+        if not ACCESS_TOKEN:
+            return {"error": "ACCESS_TOKEN not found in environment variables"}
+        if len(request.number_ids) > BULK_MAX_IDS:
+            return {"error": f"At most {BULK_MAX_IDS} phone number IDs can be deregistered per request"}
+        
+        results = await run_bulk_phone_number_action(request.number_ids, "POST", "/deregister", max_concurrency)
+        deregistered_ids = [result["number_id"] for result in results if result["success"]]
+        
+        waba_ids = await asyncio.to_thread(with_session, waba_ids_for, deregistered_ids) if deregistered_ids else {}
+        for number_id in deregistered_ids:
+            phone_number_events.publish(PHONE_NUMBER_DEREGISTERED, number_id, waba_id=waba_ids.get(number_id))
+        
+        return {
+            "requested": len(results),
+            "succeeded": len(deregistered_ids),
+            "failed": len(results) - len(deregistered_ids),
+            "results": results
+        }
+    except Exception as e:
+        return {"error": f"Failed to bulk deregister phone numbers: {str(e)}"}
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(
@@ -1,8 +1,9 @@
-from sqlalchemy import create_engine, Column, String, DateTime, ForeignKey, Integer
+from sqlalchemy import create_engine, inspect, text, Column, String, DateTime, ForeignKey, Integer, Text, Boolean
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, validates
 from datetime import datetime
 import os
+import re
 
 # Database URL configuration - supports both SQLite (local) and PostgreSQL (production)
 DATABASE_URL = os.getenv("DATABASE_URL")
@@ -18,19 +19,43 @@ else:
     SQLALCHEMY_DATABASE_URL = "sqlite:///./waba_database.db"
     connect_args = {"check_same_thread": False}
 
+# Connection pool size; DB_POOL_CAPACITY bounds how many requests can hold a session at once
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_CAPACITY = DB_POOL_SIZE + DB_MAX_OVERFLOW
+
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args=connect_args
+    SQLALCHEMY_DATABASE_URL, connect_args=connect_args,
+    pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
 
+# Digits of a phone number or search query, nothing else
+def phone_number_digits(value):
+    return re.sub(r"\D", "", value or "")
+
+# Normalize a phone number to its E.164 digits (no "+", spaces or punctuation)
+def normalize_phone_number(phone_number):
+    digits = phone_number_digits(phone_number)
+    # International dialling prefix written as 00 instead of +
+    if digits.startswith("00"):
+        digits = digits[2:]
+    return digits
+
 # Database model for WABA data
 class WabaData(Base):
     __tablename__ = "waba_data"
 
     waba_id = Column(String, primary_key=True, index=True)
     access_token = Column(String, nullable=False)
+    # Token health from debug_token, refreshed by the background checker (NULL = not checked yet)
+    token_is_valid = Column(Boolean, nullable=True)
+    token_expires_at = Column(DateTime, nullable=True, index=True)  # NULL when the token never expires
+    token_scopes = Column(Text, nullable=True)  # Comma-separated
+    token_error = Column(String, nullable=True)
+    token_checked_at = Column(DateTime, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -47,15 +72,105 @@ class WabaPhoneNumber(Base):
     display_phone_number = Column(String, nullable=False)
     code_verification_status = Column(String, nullable=True)
     verification_expiry_time = Column(String, nullable=True)
+    # Search columns: E.164 digits, and the same digits reversed so suffix lookups are index range scans
+    normalized_phone_number = Column(String, nullable=True, index=True)
+    reversed_phone_number = Column(String, nullable=True, index=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     # Relationship to WABA
     waba = relationship("WabaData", back_populates="phone_numbers")
 
+    @validates("display_phone_number")
+    def _index_phone_number(self, key, value):
+        self.normalized_phone_number = normalize_phone_number(value)
+        self.reversed_phone_number = self.normalized_phone_number[::-1]
+        return value
+
+# Database model for preverified phone numbers of a business portfolio, cached from Graph for search
+class PreverifiedPhoneNumber(Base):
+    __tablename__ = "preverified_phone_numbers"
+
+    id = Column(String, primary_key=True, index=True)  # Facebook's preverified number ID
+    portfolio_id = Column(String, nullable=False, index=True)
+    phone_number = Column(String, nullable=False)
+    code_verification_status = Column(String, nullable=True)
+    verification_expiry_time = Column(String, nullable=True)
+    normalized_phone_number = Column(String, nullable=True, index=True)
+    reversed_phone_number = Column(String, nullable=True, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    @validates("phone_number")
+    def _index_phone_number(self, key, value):
+        self.normalized_phone_number = normalize_phone_number(value)
+        self.reversed_phone_number = self.normalized_phone_number[::-1]
+        return value
+
+# Database model for business portfolios served by this backend
+class BusinessPortfolio(Base):
+    __tablename__ = "business_portfolios"
+
+    portfolio_id = Column(String, primary_key=True, index=True)
+    name = Column(String, nullable=True)
+    access_token = Column(String, nullable=False)
+    max_concurrency = Column(Integer, nullable=True)  # Concurrent Graph calls allowed for this portfolio
+    requests_per_minute = Column(Integer, nullable=True)  # Graph call budget for this portfolio
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+# Database model for stored results of idempotent mutation requests
+class IdempotencyRecord(Base):
+    __tablename__ = "idempotency_records"
+
+    scope = Column(String, primary_key=True)  # "<METHOD> <path> <Idempotency-Key>"
+    request_hash = Column(String, nullable=False)
+    status_code = Column(Integer, nullable=False)
+    response_body = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+# Add columns (and their indexes) introduced after a table was first created;
+# create_all only creates missing tables
+def add_missing_columns():
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        missing = [column for column in table.columns if column.name not in existing]
+        if not missing:
+            continue
+        with engine.begin() as connection:
+            for column in missing:
+                column_type = column.type.compile(dialect=engine.dialect)
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                print(f"Added column {table.name}.{column.name}")
+            for index in table.indexes:
+                index.create(bind=connection, checkfirst=True)
+
+# Fill search columns for phone numbers stored before they existed
+def backfill_phone_number_search_columns(batch_size=1000):
+    db = SessionLocal()
+    try:
+        while True:
+            phones = db.query(WabaPhoneNumber).filter(
+                WabaPhoneNumber.normalized_phone_number.is_(None)
+            ).limit(batch_size).all()
+            if not phones:
+                break
+            for phone in phones:
+                # Re-assigning runs the validator that sets the search columns
+                phone.display_phone_number = phone.display_phone_number
+            db.commit()
+    finally:
+        db.close()
+
 # Create tables
 def create_tables():
     Base.metadata.create_all(bind=engine)
+    add_missing_columns()
+    backfill_phone_number_search_columns()
 
 # Dependency to get database session
 def get_db():
@@ -0,0 +1,87 @@
+import asyncio
+import itertools
+import json
+import threading
+from collections import deque
+from datetime import datetime
+
+# Event types pushed to clients when a phone number changes state
+PHONE_NUMBER_ADDED = "added"
+PHONE_NUMBER_CODE_REQUESTED = "code_requested"
+PHONE_NUMBER_VERIFIED = "verified"
+PHONE_NUMBER_REGISTERED = "registered"
+PHONE_NUMBER_DEREGISTERED = "deregistered"
+PHONE_NUMBER_DELETED = "deleted"
+
+
+class PhoneNumberEventBroker:
+    """In-process fan-out of phone number status changes to SSE subscribers"""
+
+    def __init__(self, history_size=500, queue_size=100):
+        self._ids = itertools.count(1)
+        self._history = deque(maxlen=history_size)
+        self._subscribers = set()
+        self._queue_size = queue_size
+        self._loop = None
+        # Endpoints publish from threadpool workers, so ids and history are shared across threads
+        self._lock = threading.Lock()
+
+    def bind_loop(self, loop):
+        """Loop that owns the subscriber queues; called once at startup"""
+        self._loop = loop
+
+    def publish(self, event_type, phone_number_id, **data):
+        with self._lock:
+            event = {
+                "id": next(self._ids),
+                "event": event_type,
+                "phone_number_id": phone_number_id,
+                "timestamp": datetime.utcnow().isoformat(),
+                **data
+            }
+            self._history.append(event)
+
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+
+        if self._loop and running_loop is not self._loop:
+            self._loop.call_soon_threadsafe(self._dispatch, event)
+        else:
+            self._dispatch(event)
+        return event
+
+    def _dispatch(self, event):
+        for queue in list(self._subscribers):
+            if queue.full():
+                # Slow consumer: drop its oldest event rather than block publishers
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+    def events_since(self, last_event_id):
+        """Buffered events newer than last_event_id, used to resume a dropped stream"""
+        with self._lock:
+            return [event for event in self._history if event["id"] > last_event_id]
+
+    def subscribe(self):
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=self._queue_size)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self._subscribers.discard(queue)
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+
+def format_sse(event):
+    """Serialize an event dict into a text/event-stream frame"""
+    return f"id: {event['id']}\nevent: {event['event']}\ndata: {json.dumps(event)}\n\n"
+
+
+phone_number_events = PhoneNumberEventBroker()
@@ -0,0 +1,238 @@
+import contextvars
+import os
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+import requests
+
+import tracing
+
+# Default timeouts in seconds, overridable per path family with
+# GRAPH_TIMEOUT_<FAMILY>="<connect>,<read>" (e.g. GRAPH_TIMEOUT_REGISTER="3,20")
+GRAPH_CONNECT_TIMEOUT = float(os.getenv("GRAPH_CONNECT_TIMEOUT", "3.05"))
+GRAPH_READ_TIMEOUT = float(os.getenv("GRAPH_READ_TIMEOUT", "10"))
+
+# Circuit breaker settings, shared by every path family
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("GRAPH_BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("GRAPH_BREAKER_RESET_SECONDS", "30"))
+
+# Last good GET responses, served while a breaker is open
+STALE_CACHE_SIZE = int(os.getenv("GRAPH_STALE_CACHE_SIZE", "256"))
+
+# Absolute time.monotonic() deadline of the current inbound request, if any
+request_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+
+def deadline_remaining():
+    """Seconds left before the current request's deadline, or None when there is none"""
+    deadline = request_deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+class GraphUnavailableError(Exception):
+    """Raised instead of calling Graph when the call cannot complete in time"""
+
+
+class CircuitOpenError(GraphUnavailableError):
+    pass
+
+
+class DeadlineExceededError(GraphUnavailableError):
+    pass
+
+
+def path_family(url):
+    """Group Graph URLs by their edge, e.g. /{waba_id}/phone_numbers -> phone_numbers"""
+    segments = [segment for segment in urlparse(url).path.split("/") if segment]
+    # Drop the version prefix (v23.0)
+    if segments and segments[0].startswith("v") and segments[0][1:].replace(".", "").isdigit():
+        segments = segments[1:]
+    if not segments:
+        return "root"
+    if segments[0] == "oauth":
+        return "oauth"
+    if len(segments) == 1:
+        # Bare node reads/deletes such as GET or DELETE /{phone_number_id}
+        return "node"
+    return segments[-1]
+
+
+def timeout_for(family):
+    override = os.getenv(f"GRAPH_TIMEOUT_{family.upper()}")
+    if override:
+        connect, _, read = override.partition(",")
+        return float(connect), float(read or connect)
+    return GRAPH_CONNECT_TIMEOUT, GRAPH_READ_TIMEOUT
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker: closed -> open -> half-open (single trial call) -> closed"""
+
+    def __init__(self, family):
+        self.family = family
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= BREAKER_RESET_SECONDS:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def release_trial(self):
+        """End a half-open trial without counting it either way"""
+        with self._lock:
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.opened_at is not None or self.failures >= BREAKER_FAILURE_THRESHOLD:
+                self.opened_at = time.monotonic()
+
+    def snapshot(self):
+        retry_in = None
+        if self.opened_at is not None:
+            retry_in = max(0.0, round(BREAKER_RESET_SECONDS - (time.monotonic() - self.opened_at), 1))
+        return {"state": self.state, "consecutive_failures": self.failures, "retry_in_seconds": retry_in}
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+_stale_cache = OrderedDict()
+_stale_cache_lock = threading.Lock()
+
+
+def breaker_for(family):
+    with _breakers_lock:
+        if family not in _breakers:
+            _breakers[family] = CircuitBreaker(family)
+        return _breakers[family]
+
+
+def breaker_states():
+    with _breakers_lock:
+        return {family: breaker.snapshot() for family, breaker in _breakers.items()}
+
+
+def _cache_key(url, params):
+    return url, tuple(sorted((params or {}).items()))
+
+
+def _remember(key, response):
+    with _stale_cache_lock:
+        _stale_cache[key] = response
+        _stale_cache.move_to_end(key)
+        while len(_stale_cache) > STALE_CACHE_SIZE:
+            _stale_cache.popitem(last=False)
+
+
+def _stale(key):
+    with _stale_cache_lock:
+        return _stale_cache.get(key)
+
+
+def request(method, url, **kwargs):
+    """requests.request with per-family timeouts, the request deadline and a circuit breaker applied"""
+    family = path_family(url)
+    configured_connect_timeout, configured_read_timeout = timeout_for(family)
+    connect_timeout, read_timeout = configured_connect_timeout, configured_read_timeout
+
+    remaining = deadline_remaining()
+    if remaining is not None:
+        if remaining <= 0:
+            raise DeadlineExceededError(f"Request deadline exceeded before calling Graph ({family})")
+        connect_timeout = min(connect_timeout, remaining)
+        read_timeout = min(read_timeout, remaining)
+
+    # Streamed bodies are not buffered, so they can neither be cached nor replayed
+    cache_key = _cache_key(url, kwargs.get("params")) if method == "GET" and not kwargs.get("stream") else None
+    breaker = breaker_for(family)
+    if not breaker.allow():
+        stale_response = _stale(cache_key) if cache_key else None
+        if stale_response is not None:
+            print(f"Graph circuit for '{family}' is open, serving cached response for {url}")
+            return stale_response
+        snapshot = breaker.snapshot()
+        raise CircuitOpenError(
+            f"Graph API '{family}' calls are failing, retry in {snapshot['retry_in_seconds']}s"
+        )
+
+    recorded = False
+    try:
+        with tracing.span(
+            f"graph {method} {family}",
+            "graph",
+            kind=tracing.SPAN_KIND_CLIENT,
+            **{"http.request.method": method, "url.path": urlparse(url).path, "graph.family": family}
+        ) as graph_span:
+            try:
+                response = requests.request(method, url, timeout=(connect_timeout, read_timeout), **kwargs)
+            except requests.ConnectTimeout:
+                # A timeout shortened by the caller's deadline says nothing about Graph's health
+                if connect_timeout >= configured_connect_timeout:
+                    breaker.record_failure()
+                    recorded = True
+                raise
+            except requests.Timeout:
+                if read_timeout >= configured_read_timeout:
+                    breaker.record_failure()
+                    recorded = True
+                raise
+            except requests.RequestException:
+                breaker.record_failure()
+                recorded = True
+                raise
+            if graph_span:
+                graph_span.attributes["http.response.status_code"] = response.status_code
+
+        # Only upstream faults count against the breaker; 4xx are caller errors
+        if response.status_code >= 500 or response.status_code == 429:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+            if cache_key and response.status_code == 200:
+                _remember(cache_key, response)
+        recorded = True
+        return response
+    finally:
+        if not recorded:
+            # Never leave a half-open breaker waiting on a trial that ended without an outcome
+            breaker.release_trial()
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def delete(url, **kwargs):
+    return request("DELETE", url, **kwargs)
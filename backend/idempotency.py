@@ -0,0 +1,178 @@
+import asyncio
+import hashlib
+import json
+import re
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from fastapi.responses import JSONResponse, Response
+
+from database import SessionLocal, IdempotencyRecord
+
+IDEMPOTENCY_HEADER = "idempotency-key"
+MAX_KEY_LENGTH = 255
+PURGE_INTERVAL_SECONDS = 60
+
+
+class IdempotencyStore:
+    """Answers retried mutation requests carrying an Idempotency-Key from stored results.
+
+    Successful responses are persisted in the idempotency_records table for ttl_seconds and
+    mirrored in a small in-memory cache; concurrent duplicates of a request still in flight
+    wait for the first one instead of calling Graph again.
+    """
+
+    def __init__(self, routes, ttl_seconds=86400, hot_cache_size=1024):
+        self._routes = [(method, re.compile(pattern)) for method, pattern in routes]
+        self.ttl_seconds = ttl_seconds
+        self._hot_cache_size = hot_cache_size
+        self._hot = OrderedDict()
+        self._in_flight = {}
+        self._last_purge = 0.0
+
+    def applies(self, method, path):
+        return any(method == route_method and pattern.fullmatch(path) for route_method, pattern in self._routes)
+
+    async def handle(self, request, call_next):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not key or not self.applies(request.method, request.url.path):
+            return await call_next(request)
+
+        if len(key) > MAX_KEY_LENGTH:
+            return JSONResponse(status_code=400, content={"error": f"Idempotency-Key must be at most {MAX_KEY_LENGTH} characters"})
+
+        body = await request.body()
+        request_hash = hashlib.sha256(request.url.query.encode() + b"\n" + body).hexdigest()
+        scope = f"{request.method} {request.url.path} {key}"
+
+        # Hot cache on the loop; the table lookup is a blocking round trip, so it runs in a worker thread
+        stored = self._cached(scope)
+        if not stored:
+            stored = await asyncio.to_thread(self._load, scope)
+            if stored:
+                self._remember(scope, stored)
+            else:
+                # A duplicate may have finished while we were querying
+                stored = self._cached(scope)
+        if stored:
+            if stored["request_hash"] != request_hash:
+                return self._key_reused()
+            return self._replay(stored["status_code"], stored["body"])
+
+        in_flight = self._in_flight.get(scope)
+        if in_flight:
+            leader_hash, future = in_flight
+            if leader_hash != request_hash:
+                return self._key_reused()
+            result = await asyncio.shield(future)
+            if result:
+                return self._replay(*result)
+            # The first request crashed without a response; run this one normally
+            return await call_next(request)
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[scope] = (request_hash, future)
+        result = None
+        try:
+            response = await call_next(request)
+            content = b"".join([chunk async for chunk in response.body_iterator])
+            result = (response.status_code, content)
+            if self._storable(response.status_code, content):
+                await self._save(scope, request_hash, response.status_code, content)
+            return Response(content=content, status_code=response.status_code, headers=dict(response.headers))
+        finally:
+            del self._in_flight[scope]
+            future.set_result(result)
+
+    def _cached(self, scope):
+        cached = self._hot.get(scope)
+        if cached:
+            if cached["expires_at"] > datetime.utcnow():
+                return cached
+            del self._hot[scope]
+        return None
+
+    def _load(self, scope):
+        db = SessionLocal()
+        try:
+            record = db.query(IdempotencyRecord).filter(
+                IdempotencyRecord.scope == scope,
+                IdempotencyRecord.expires_at > datetime.utcnow()
+            ).first()
+            if not record:
+                return None
+            return {
+                "request_hash": record.request_hash,
+                "status_code": record.status_code,
+                "body": record.response_body.encode(),
+                "expires_at": record.expires_at
+            }
+        finally:
+            db.close()
+
+    async def _save(self, scope, request_hash, status_code, content):
+        stored = {
+            "request_hash": request_hash,
+            "status_code": status_code,
+            "body": content,
+            "expires_at": datetime.utcnow() + timedelta(seconds=self.ttl_seconds)
+        }
+        self._remember(scope, stored)
+
+        purge = time.monotonic() - self._last_purge > PURGE_INTERVAL_SECONDS
+        if purge:
+            self._last_purge = time.monotonic()
+        await asyncio.to_thread(self._persist, scope, stored, purge)
+
+    def _persist(self, scope, stored, purge):
+        db = SessionLocal()
+        try:
+            db.merge(IdempotencyRecord(
+                scope=scope,
+                request_hash=stored["request_hash"],
+                status_code=stored["status_code"],
+                response_body=stored["body"].decode(),
+                expires_at=stored["expires_at"]
+            ))
+            if purge:
+                db.query(IdempotencyRecord).filter(IdempotencyRecord.expires_at <= datetime.utcnow()).delete()
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print(f"Error storing idempotency record: {str(e)}")
+        finally:
+            db.close()
+
+    def _remember(self, scope, stored):
+        self._hot[scope] = stored
+        self._hot.move_to_end(scope)
+        while len(self._hot) > self._hot_cache_size:
+            self._hot.popitem(last=False)
+
+    @staticmethod
+    def _storable(status_code, content):
+        # Endpoints report Graph failures as 200 {"error": ...}; those must stay retryable
+        if status_code != 200:
+            return False
+        try:
+            data = json.loads(content)
+        except ValueError:
+            return False
+        return not (isinstance(data, dict) and "error" in data)
+
+    @staticmethod
+    def _replay(status_code, content):
+        return Response(
+            content=content,
+            status_code=status_code,
+            media_type="application/json",
+            headers={"Idempotent-Replayed": "true"}
+        )
+
+    @staticmethod
+    def _key_reused():
+        return JSONResponse(
+            status_code=422,
+            content={"error": "Idempotency-Key was already used with a different request"}
+        )
@@ -0,0 +1,141 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from database import BusinessPortfolio
+
+# Budgets for portfolios that don't set their own
+PORTFOLIO_MAX_CONCURRENCY = int(os.getenv("PORTFOLIO_MAX_CONCURRENCY", "4"))
+PORTFOLIO_REQUESTS_PER_MINUTE = int(os.getenv("PORTFOLIO_REQUESTS_PER_MINUTE", "200"))
+# How long a call may wait for a free connection slot before giving up
+PORTFOLIO_BUDGET_WAIT_SECONDS = float(os.getenv("PORTFOLIO_BUDGET_WAIT_SECONDS", "5"))
+
+
+class PortfolioBudgetExceededError(Exception):
+    pass
+
+
+class PortfolioBudget:
+    """Caps concurrent Graph calls (semaphore) and call rate (token bucket) for one portfolio"""
+
+    def __init__(self, portfolio_id, max_concurrency, requests_per_minute):
+        self.portfolio_id = portfolio_id
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._tokens = float(requests_per_minute)
+        self._refilled_at = time.monotonic()
+        self._lock = threading.Lock()
+        self.in_flight = 0
+
+    def _take_token(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                float(self.requests_per_minute),
+                self._tokens + (now - self._refilled_at) * self.requests_per_minute / 60.0
+            )
+            self._refilled_at = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    @contextmanager
+    def reserve(self, wait_seconds=PORTFOLIO_BUDGET_WAIT_SECONDS):
+        if not self._take_token():
+            raise PortfolioBudgetExceededError(
+                f"Portfolio {self.portfolio_id} exceeded {self.requests_per_minute} Graph calls per minute"
+            )
+        if not self._slots.acquire(timeout=wait_seconds):
+            raise PortfolioBudgetExceededError(
+                f"Portfolio {self.portfolio_id} has all {self.max_concurrency} Graph connections busy"
+            )
+        with self._lock:
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            self._slots.release()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "max_concurrency": self.max_concurrency,
+                "requests_per_minute": self.requests_per_minute,
+                "in_flight": self.in_flight,
+                "available_calls": int(self._tokens)
+            }
+
+
+_budgets = {}
+_budgets_lock = threading.Lock()
+
+
+def budget_for(portfolio):
+    """Shared budget for a resolved portfolio, rebuilt if its configured limits change"""
+    max_concurrency = portfolio["max_concurrency"]
+    requests_per_minute = portfolio["requests_per_minute"]
+    with _budgets_lock:
+        budget = _budgets.get(portfolio["portfolio_id"])
+        if not budget or (budget.max_concurrency, budget.requests_per_minute) != (max_concurrency, requests_per_minute):
+            budget = PortfolioBudget(portfolio["portfolio_id"], max_concurrency, requests_per_minute)
+            _budgets[portfolio["portfolio_id"]] = budget
+        return budget
+
+
+def portfolio_from_record(record):
+    return {
+        "portfolio_id": record.portfolio_id,
+        "name": record.name,
+        "access_token": record.access_token,
+        "max_concurrency": record.max_concurrency or PORTFOLIO_MAX_CONCURRENCY,
+        "requests_per_minute": record.requests_per_minute or PORTFOLIO_REQUESTS_PER_MINUTE
+    }
+
+
+def resolve_portfolio(db, portfolio_id, default_portfolio_id, default_access_token):
+    """Look up a portfolio in the registry, falling back to the one configured in the environment.
+
+    Returns (portfolio, error) where error is an endpoint-style error dict.
+    """
+    if portfolio_id and portfolio_id != default_portfolio_id:
+        record = db.query(BusinessPortfolio).filter(BusinessPortfolio.portfolio_id == portfolio_id).first()
+        if not record:
+            return None, {"error": f"Business portfolio {portfolio_id} is not registered"}
+        return portfolio_from_record(record), None
+
+    if not default_portfolio_id:
+        return None, {"error": "BUSINESS_PORTFOLIO_ID not found in environment variables"}
+
+    # The environment portfolio may also be registered, e.g. to give it its own token or budget
+    record = db.query(BusinessPortfolio).filter(BusinessPortfolio.portfolio_id == default_portfolio_id).first()
+    if record:
+        return portfolio_from_record(record), None
+
+    if not default_access_token:
+        return None, {"error": "ACCESS_TOKEN not found in environment variables"}
+    return {
+        "portfolio_id": default_portfolio_id,
+        "name": None,
+        "access_token": default_access_token,
+        "max_concurrency": PORTFOLIO_MAX_CONCURRENCY,
+        "requests_per_minute": PORTFOLIO_REQUESTS_PER_MINUTE
+    }, None
+
+
+def all_portfolios(db, default_portfolio_id, default_access_token):
+    """Every registered portfolio, plus the environment one when it isn't registered"""
+    portfolios = [portfolio_from_record(record) for record in db.query(BusinessPortfolio).all()]
+    if default_portfolio_id and default_access_token and default_portfolio_id not in {p["portfolio_id"] for p in portfolios}:
+        portfolios.append({
+            "portfolio_id": default_portfolio_id,
+            "name": None,
+            "access_token": default_access_token,
+            "max_concurrency": PORTFOLIO_MAX_CONCURRENCY,
+            "requests_per_minute": PORTFOLIO_REQUESTS_PER_MINUTE
+        })
+    return portfolios
@@ -0,0 +1,119 @@
+import asyncio
+import json
+import os
+from datetime import datetime
+from urllib.parse import urlencode
+
+import graph_client
+from database import SessionLocal, WabaData
+
+# How often stored WABA tokens are re-checked, and how many go into one Graph batch request (max 50)
+TOKEN_HEALTH_INTERVAL_SECONDS = float(os.getenv("TOKEN_HEALTH_INTERVAL_SECONDS", "3600"))
+TOKEN_HEALTH_BATCH_SIZE = min(50, int(os.getenv("TOKEN_HEALTH_BATCH_SIZE", "50")))
+# Whether endpoints may use ACCESS_TOKEN when a WABA's stored token is known to be unusable
+TOKEN_HEALTH_ALLOW_FALLBACK = os.getenv("TOKEN_HEALTH_ALLOW_FALLBACK", "true").lower() in ("1", "true", "yes")
+
+
+def token_problem(waba_data, now=None):
+    """Why a stored WABA token can't be used, or None if it is (or may be) fine"""
+    if waba_data.token_is_valid is False:
+        return f"Stored access token for WABA {waba_data.waba_id} is invalid: {waba_data.token_error or 'rejected by debug_token'}"
+    now = now or datetime.utcnow()
+    if waba_data.token_expires_at and waba_data.token_expires_at <= now:
+        return f"Stored access token for WABA {waba_data.waba_id} expired at {waba_data.token_expires_at.isoformat()}"
+    return None
+
+
+def resolve_waba_token(waba_data, default_access_token):
+    """Token to use for a WABA without calling Graph, returns (access_token, error)"""
+    if not waba_data:
+        return default_access_token, None
+    problem = token_problem(waba_data)
+    if not problem:
+        return waba_data.access_token, None
+    if TOKEN_HEALTH_ALLOW_FALLBACK and default_access_token:
+        print(f"{problem}; falling back to ACCESS_TOKEN")
+        return default_access_token, None
+    return None, {"error": problem, "token_unusable": True}
+
+
+def _debug_token_batch(tokens, app_token):
+    """Run debug_token for up to 50 tokens in one Graph batch request"""
+    batch = [
+        {"method": "GET", "relative_url": "debug_token?" + urlencode({"input_token": token})}
+        for token in tokens
+    ]
+    response = graph_client.post(
+        "https://graph.facebook.com/v23.0/",
+        data={"access_token": app_token, "batch": json.dumps(batch)}
+    )
+    if response.status_code != 200:
+        raise RuntimeError(f"Facebook API error: {response.status_code} - {response.text}")
+
+    results = []
+    for item in response.json():
+        if not item or item.get("code") != 200:
+            results.append(None)
+            continue
+        results.append(json.loads(item["body"]).get("data", {}))
+    return results
+
+
+def _apply_debug_data(waba_data, data, checked_at):
+    waba_data.token_checked_at = checked_at
+    if data is None:
+        # Lookup itself failed; keep the last known state
+        return
+    waba_data.token_is_valid = bool(data.get("is_valid"))
+    expires_at = data.get("expires_at")
+    waba_data.token_expires_at = datetime.utcfromtimestamp(expires_at) if expires_at else None
+    waba_data.token_scopes = ",".join(data.get("scopes", [])) or None
+    waba_data.token_error = data.get("error", {}).get("message")
+
+
+def check_stored_tokens(app_id, app_secret, batch_size=TOKEN_HEALTH_BATCH_SIZE):
+    """Refresh token health columns for every stored WABA, returns the number of tokens checked"""
+    app_token = f"{app_id}|{app_secret}"
+    checked = 0
+    # Snapshot the tokens so no session is held while Graph answers
+    db = SessionLocal()
+    try:
+        wabas = db.query(WabaData.waba_id, WabaData.access_token).order_by(WabaData.waba_id).all()
+    finally:
+        db.close()
+
+    for start in range(0, len(wabas), batch_size):
+        batch = wabas[start:start + batch_size]
+        try:
+            results = _debug_token_batch([access_token for _, access_token in batch], app_token)
+        except Exception as e:
+            print(f"Error checking token batch: {str(e)}")
+            continue
+        checked_at = datetime.utcnow()
+        db = SessionLocal()
+        try:
+            for (waba_id, access_token), data in zip(batch, results):
+                waba_data = db.query(WabaData).filter(WabaData.waba_id == waba_id).first()
+                # Skip WABAs deleted or given a new token (e.g. by /exchange-token) since the snapshot
+                if not waba_data or waba_data.access_token != access_token:
+                    continue
+                _apply_debug_data(waba_data, data, checked_at)
+            db.commit()
+        finally:
+            db.close()
+        checked += len(batch)
+    return checked
+
+
+async def run_token_health_loop(app_id, app_secret, interval=TOKEN_HEALTH_INTERVAL_SECONDS):
+    """Background task started with the app; checks tokens once per interval"""
+    if not app_id or not app_secret:
+        print("FACEBOOK_APP_ID or FACEBOOK_APP_SECRET not set, token health checks disabled")
+        return
+    while True:
+        try:
+            checked = await asyncio.to_thread(check_stored_tokens, app_id, app_secret)
+            print(f"Token health check completed for {checked} WABA tokens")
+        except Exception as e:
+            print(f"Token health check failed: {str(e)}")
+        await asyncio.sleep(interval)
@@ -0,0 +1,245 @@
+import contextvars
+import json
+import os
+import queue
+import random
+import re
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+from fastapi.responses import JSONResponse
+from sqlalchemy import event
+
+# Fraction of requests whose spans are exported (Server-Timing is always sent)
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.1"))
+# Append sampled spans as OTLP/JSON lines to this file
+TRACE_EXPORT_FILE = os.getenv("TRACE_EXPORT_FILE")
+# OTLP/HTTP collector base URL, e.g. http://localhost:4318
+OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT")
+SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "waba-backend")
+
+# OpenTelemetry span kinds
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+
+TRACEPARENT_PATTERN = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, name, kind, category=None, parent=None, trace_id=None, parent_span_id=None, sampled=False, attributes=None):
+        self.name = name
+        self.kind = kind
+        self.category = category
+        self.root = parent.root if parent else self
+        self.trace_id = parent.trace_id if parent else (trace_id or secrets.token_hex(16))
+        self.span_id = secrets.token_hex(8)
+        self.parent_span_id = parent.span_id if parent else parent_span_id
+        self.sampled = parent.sampled if parent else sampled
+        self.attributes = dict(attributes or {})
+        self.error = None
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.duration_ms = None
+        self._started = time.perf_counter()
+        if self.root is self:
+            # Per-category totals for the Server-Timing header, shared by every span of the request
+            self.timings = {}
+            self._timings_lock = threading.Lock()
+
+    def add_timing(self, category, duration_ms):
+        with self._timings_lock:
+            total, count = self.timings.get(category, (0.0, 0))
+            self.timings[category] = (total + duration_ms, count + 1)
+
+    def end(self):
+        self.end_ns = time.time_ns()
+        self.duration_ms = (time.perf_counter() - self._started) * 1000
+        if self.category and self.root is not self:
+            self.root.add_timing(self.category, self.duration_ms)
+        if self.sampled:
+            exporter.export(self)
+
+    def server_timing(self):
+        """Server-Timing header value summarising time per category for this request"""
+        entries = [
+            f'{category};dur={total:.1f};desc="{count} call{"s" if count != 1 else ""}"'
+            for category, (total, count) in sorted(self.timings.items())
+        ]
+        entries.append(f"total;dur={self.duration_ms:.1f}")
+        return ", ".join(entries)
+
+    def to_otlp(self):
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [_otlp_attribute(key, value) for key, value in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1}
+        }
+        if self.parent_span_id:
+            span["parentSpanId"] = self.parent_span_id
+        return span
+
+
+def _otlp_attribute(key, value):
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+class SpanExporter:
+    """Background batch export of finished spans to a JSON-lines file and/or an OTLP/HTTP collector"""
+
+    def __init__(self, file_path=None, otlp_endpoint=None, batch_size=256, flush_seconds=2.0):
+        self.file_path = file_path
+        self.otlp_endpoint = otlp_endpoint.rstrip("/") + "/v1/traces" if otlp_endpoint else None
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self._queue = queue.Queue(maxsize=10000)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.file_path or self.otlp_endpoint)
+
+    def export(self, span):
+        if not self.enabled:
+            return
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(span.to_otlp())
+        except queue.Full:
+            pass  # Dropping spans is preferable to slowing requests down
+
+    def _ensure_started(self):
+        if self._thread:
+            return
+        with self._lock:
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_seconds
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, spans):
+        payload = {
+            "resourceSpans": [{
+                "resource": {"attributes": [_otlp_attribute("service.name", SERVICE_NAME)]},
+                "scopeSpans": [{"scope": {"name": SERVICE_NAME}, "spans": spans}]
+            }]
+        }
+        try:
+            if self.file_path:
+                with open(self.file_path, "a") as trace_file:
+                    trace_file.write(json.dumps(payload) + "\n")
+            if self.otlp_endpoint:
+                requests.post(self.otlp_endpoint, json=payload, timeout=5)
+        except Exception as e:
+            print(f"Error exporting {len(spans)} spans: {str(e)}")
+
+
+exporter = SpanExporter(file_path=TRACE_EXPORT_FILE, otlp_endpoint=OTLP_ENDPOINT)
+
+
+def start_request_span(name, traceparent=None, attributes=None):
+    """Root SERVER span for an inbound request, continuing a W3C traceparent when one is sent"""
+    match = TRACEPARENT_PATTERN.match(traceparent or "")
+    if match:
+        trace_id, parent_span_id, flags = match.groups()
+        sampled = bool(int(flags, 16) & 1)
+    else:
+        trace_id, parent_span_id = None, None
+        sampled = random.random() < TRACE_SAMPLE_RATE
+    return Span(
+        name,
+        SPAN_KIND_SERVER,
+        trace_id=trace_id,
+        parent_span_id=parent_span_id,
+        sampled=sampled and exporter.enabled,
+        attributes=attributes
+    )
+
+
+@contextmanager
+def span(name, category, kind=SPAN_KIND_INTERNAL, **attributes):
+    """Child span of the current request; a no-op outside of a traced request"""
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(name, kind, category=category, parent=parent, attributes=attributes)
+    token = current_span.set(child)
+    try:
+        yield child
+    except Exception as e:
+        child.error = str(e)
+        raise
+    finally:
+        current_span.reset(token)
+        child.end()
+
+
+def instrument_engine(engine):
+    """Record a 'db' span for every SQL statement executed on the engine"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        parent = current_span.get()
+        if parent is None:
+            return
+        operation = statement.split(None, 1)[0].upper() if statement else "SQL"
+        db_span = Span(
+            f"db {operation}",
+            SPAN_KIND_CLIENT,
+            category="db",
+            parent=parent,
+            attributes={"db.system": engine.dialect.name, "db.statement": statement}
+        )
+        conn.info.setdefault("trace_spans", []).append(db_span)
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if conn.info.get("trace_spans"):
+            conn.info["trace_spans"].pop().end()
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(exception_context):
+        conn = exception_context.connection
+        if conn is not None and conn.info.get("trace_spans"):
+            db_span = conn.info["trace_spans"].pop()
+            db_span.error = str(exception_context.original_exception)
+            db_span.end()
+
+
+class TracedJSONResponse(JSONResponse):
+    """JSONResponse that records JSON encoding time as a 'serialize' span"""
+
+    def render(self, content):
+        with span("serialize json", "serialize"):
+            return super().render(content)